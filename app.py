@@ -1,4 +1,5 @@
 #!venv/bin/python
+import signal
 import argparse
 import logging
 import asyncio
@@ -6,10 +7,14 @@ import motor.motor_asyncio
 from aiohttp import web
 
 from config import config, logger_configure
+import auth
+import audit
+import utils
 import message_queue.delivery_handlers
 from message_queue.connect import QueueListener
 from notification import handlers as nh, processing as np
 from currency.daemon import CurrencyUpdateDaemon
+from supervisor import Supervisor
 
 __author__ = 'Kostel Serhii'
 
@@ -28,10 +33,22 @@ async def shutdown(app):
     if queue_connect:
         await queue_connect.close()
 
+    await audit.close_audit_log()
+
     currency_daemon = app.get('currency_daemon')
     if currency_daemon:
         currency_daemon.stop()
 
+    notify_processor = app.get('notify_processor')
+    if notify_processor:
+        notify_processor.stop()
+
+    await utils.flush_admin_reports()
+
+    auth.system_token.stop()
+    await utils.close_smtp_pool()
+    utils.close_http_session()
+
     _log.info('Shutdown tasks')
     tasks = asyncio.Task.all_tasks()
     if tasks:
@@ -58,11 +75,41 @@ def register_handlers(app):
     app.router.add_route('PUT', url_prefix + '/notifications/{notify_id}', nh.notification_update)
     app.router.add_route('DELETE', url_prefix + '/notifications/{notify_id}', nh.notification_delete)
 
+    app.router.add_route('GET', url_prefix + '/deliveries', nh.deliveries_list)
 
-def create_app(loop=None):
+    app.router.add_route('GET', url_prefix + '/metrics', nh.metrics_export)
+
+
+def queue_handlers(notify_processor):
+    """
+    Queue consumers: queue name, handler and consumer options.
+    :param notify_processor: notification processing for the requests queue
+    :return: list of tuples (queue name, handler, options)
+    """
+    return [
+        (config['QUEUE_TRANS_STATUS'], message_queue.delivery_handlers.transaction_queue_handler, dict(
+            config['QUEUE_CONSUMER_OPTIONS'].get(config['QUEUE_TRANS_STATUS'], {}),
+            retry_delays=config['QUEUE_TRANS_STATUS_RETRY_DELAYS'],
+            retry_failed_callback=message_queue.delivery_handlers.transaction_retry_failed
+        )),
+        (config['QUEUE_EMAIL'], message_queue.delivery_handlers.email_queue_handler,
+         config['QUEUE_CONSUMER_OPTIONS'].get(config['QUEUE_EMAIL'])),
+        (config['QUEUE_SMS'], message_queue.delivery_handlers.sms_queue_handler,
+         config['QUEUE_CONSUMER_OPTIONS'].get(config['QUEUE_SMS'])),
+        (config['QUEUE_REQUEST'], notify_processor.request_queue_handler,
+         config['QUEUE_CONSUMER_OPTIONS'].get(config['QUEUE_REQUEST'])),
+    ]
+
+
+def create_app(loop=None, queue_names=None, worker=False, db=None):
     """
     Create server application and all necessary services.
     :param loop: async main loop
+    :param queue_names: names of the queues to consume. If None - consume all queues
+    :param worker: True - queue worker process: do not run currency daemon.
+        Workers, that consume requests queue, reload notifications from database periodically,
+        other workers do not load notifications at all
+    :param db: motor database. If None - connect to the local MongoDB
     """
 
     app = web.Application(loop=loop)
@@ -70,28 +117,37 @@ def create_app(loop=None):
 
     register_handlers(app)
 
-    motor_client = motor.motor_asyncio.AsyncIOMotorClient()
-    db = motor_client[config['DB_NAME']]
+    auth.system_token.start()
+    utils.setup_smtp_pool(loop=loop)
+    utils.setup_http_session(loop=loop)
+
+    if db is None:
+        motor_client = motor.motor_asyncio.AsyncIOMotorClient()
+        db = motor_client[config['DB_NAME']]
     app['db'] = db
 
+    audit.setup_audit_log(db)
+
     notify_processor = np.NotifyProcessing(
         db=db,
-        admin_base_url=config['ADMIN_BASE_URL']
+        admin_base_url=config['ADMIN_BASE_URL'],
+        template_cache_size=config['NOTIFY_TEMPLATE_CACHE_SIZE']
     )
-    notify_processor.start()
+    if not worker:
+        notify_processor.start()
+    elif queue_names is None or config['QUEUE_REQUEST'] in queue_names:
+        notify_processor.start(reload_interval=config['NOTIFY_RULES_RELOAD_SEC'])
     app['notify_processor'] = notify_processor
 
-    queue_connect = QueueListener(
-        queue_handlers=[
-            (config['QUEUE_TRANS_STATUS'], message_queue.delivery_handlers.transaction_queue_handler),
-            (config['QUEUE_EMAIL'], message_queue.delivery_handlers.email_queue_handler),
-            (config['QUEUE_SMS'], message_queue.delivery_handlers.sms_queue_handler),
-            (config['QUEUE_REQUEST'], notify_processor.request_queue_handler),
-        ],
-        connect_parameters=config
-    )
-    queue_connect.start()
-    app['queue_connect'] = queue_connect
+    handlers = [handler for handler in queue_handlers(notify_processor)
+                if queue_names is None or handler[0] in queue_names]
+    if handlers:
+        queue_connect = QueueListener(queue_handlers=handlers, connect_parameters=config)
+        queue_connect.start()
+        app['queue_connect'] = queue_connect
+
+    if worker:
+        return app
 
     currency_daemon = CurrencyUpdateDaemon(
         admin_base_url=config['ADMIN_BASE_URL'],
@@ -104,21 +160,150 @@ def create_app(loop=None):
     return app
 
 
+_STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+def _process_loop():
+    """
+    Create event loop for the forked process.
+    Signal handlers, inherited from the supervisor, are reset.
+    SIGTERM and SIGINT stop the loop.
+    """
+    for signum in _STOP_SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for signum in _STOP_SIGNALS:
+        loop.add_signal_handler(signum, loop.stop)
+    return loop
+
+
+def _ignore_stop_signals(loop):
+    """
+    Remove loop stop handlers and ignore SIGTERM and SIGINT before shutdown,
+    so the repeated signal (e.g. Ctrl-C in terminal and SIGTERM from supervisor)
+    does not stop the loop in the middle of shutdown.
+    Supervisor kills the process, if shutdown takes too long.
+    """
+    for signum in _STOP_SIGNALS:
+        loop.remove_signal_handler(signum)
+        signal.signal(signum, signal.SIG_IGN)
+
+
+def run_api():
+    """
+    API process in the worker mode.
+    Serve API and run currency daemon without queue consumers.
+    """
+    loop = _process_loop()
+    web_app = create_app(loop=loop, queue_names=())
+    web_app.on_shutdown.append(lambda app: _ignore_stop_signals(loop))
+    web_app.on_shutdown.append(shutdown)
+    web.run_app(web_app, host='127.0.0.1', port=config['PORT'])
+
+
+def run_queue_worker(queue_name, metrics_port=None):
+    """
+    Queue consumer process in the worker mode.
+    :param queue_name: name of the queue to consume
+    :param metrics_port: port to serve worker process metrics. If None - do not serve metrics
+    """
+    loop = _process_loop()
+    app = create_app(loop=loop, queue_names=(queue_name,), worker=True)
+
+    metrics_server = None
+    if metrics_port:
+        metrics_app = web.Application(loop=loop)
+        metrics_app.router.add_route('GET', '/api/notify/{API_VERSION}/metrics'.format(**config), nh.metrics_export)
+        metrics_server = loop.run_until_complete(
+            loop.create_server(metrics_app.make_handler(), '127.0.0.1', metrics_port))
+
+    _log.info('Queue worker for %s started', queue_name)
+    loop.run_forever()
+    _ignore_stop_signals(loop)
+
+    if metrics_server:
+        metrics_server.close()
+    loop.run_until_complete(shutdown(app))
+    loop.close()
+
+
+def queue_workers_count(workers, queue_workers=None):
+    """
+    Number of worker processes for every queue.
+    Every queue must have at least one worker: API process does not consume queues.
+    :param int workers: default number of workers per queue (at least 1 is used)
+    :param list queue_workers: overridden counts as strings QUEUE=N
+    :return: dict {queue name: workers count}
+    :raise ValueError: wrong queue workers or queue without workers
+    """
+    queue_names = [config[key] for key in ('QUEUE_TRANS_STATUS', 'QUEUE_EMAIL', 'QUEUE_SMS', 'QUEUE_REQUEST')]
+    counts = {name: config['QUEUE_WORKERS'].get(name, max(workers, 1)) for name in queue_names}
+
+    for item in queue_workers or []:
+        name, _, count = item.partition('=')
+        if name not in counts or not count.isdigit():
+            raise ValueError('Wrong queue workers "%s". Use QUEUE=N, where QUEUE is one of: %s' %
+                             (item, ', '.join(queue_names)))
+        counts[name] = int(count)
+
+    idle_queues = sorted(name for name, count in counts.items() if count < 1)
+    if idle_queues:
+        raise ValueError('Queues without workers: %s. Every queue needs at least 1 worker' % ', '.join(idle_queues))
+
+    return counts
+
+
+def run_supervisor(workers_count):
+    """
+    Run API process and queue worker processes under supervisor.
+    :param dict workers_count: number of worker processes for every queue
+    """
+    supervisor = Supervisor(stop_timeout=config['WORKER_STOP_TIMEOUT_SEC'])
+    supervisor.add_worker('api', run_api)
+
+    metrics_port = config['WORKER_METRICS_PORT']
+    for queue_name, count in sorted(workers_count.items()):
+        for n in range(count):
+            supervisor.add_worker('%s-%d' % (queue_name, n), run_queue_worker, queue_name, metrics_port)
+            if metrics_port:
+                metrics_port += 1
+
+    supervisor.run()
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='XOPay Notify Service.', allow_abbrev=False)
     parser.add_argument('--config', default='debug', help='load config: [debug, production] (default "debug")')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='worker processes per queue, API runs in the separate process. '
+                             '0 - run everything in one process, unless --queue-workers is set (default 0)')
+    parser.add_argument('--queue-workers', action='append', metavar='QUEUE=N',
+                        help='worker processes for the queue (overrides --workers, other queues get '
+                             'max(--workers, 1) workers), can be repeated')
 
     args = parser.parse_args()
     config.load_config(args.config)
 
     logger_configure(config)
 
-    web_app = create_app()
-    web_app.on_shutdown.append(shutdown)
-
-    _log.info('Starting XOPay Notify Service...')
     if config['DEBUG']:
         _log.warning('Debug mode is active!')
 
-    web.run_app(web_app, host='127.0.0.1', port=config['PORT'])
+    if args.workers or args.queue_workers:
+        try:
+            workers_count = queue_workers_count(args.workers, args.queue_workers)
+        except ValueError as err:
+            parser.error(str(err))
+
+        _log.info('Starting XOPay Notify Service in worker mode: %r', workers_count)
+        run_supervisor(workers_count)
+
+    else:
+        web_app = create_app()
+        web_app.on_shutdown.append(shutdown)
+
+        _log.info('Starting XOPay Notify Service...')
+        web.run_app(web_app, host='127.0.0.1', port=config['PORT'])
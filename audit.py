@@ -0,0 +1,194 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+from config import config
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.audit')
+_audit_log = None
+
+
+class DeliveryAuditLog:
+    """
+    Delivery records log in the MongoDB collection.
+    * Records are buffered in memory and inserted with one bulk insert
+      when buffer reaches batch size or after max delay from the first record.
+    * Buffer is limited, records over the limit are dropped and counted.
+    * Records are removed by the database after TTL (TTL index on created_at).
+    """
+
+    def __init__(self, collection, batch_size=200, max_delay=1.0, max_buffer=10000, ttl=timedelta(days=30)):
+        """
+        :param collection: motor collection
+        :param int batch_size: number of records to flush immediately
+        :param max_delay: max time in seconds to keep record in the buffer
+        :param int max_buffer: maximum number of buffered records
+        :param timedelta ttl: records retention time
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_buffer = max_buffer
+        self.ttl = ttl
+
+        self.inserted = 0
+        self.dropped = 0
+
+        self._buffer = []
+        self._flush_handle = None
+        self._flush_tasks = set()
+
+    async def ensure_indexes(self):
+        """ Create TTL index for retention and compound indexes for lookups. """
+        indexes = (
+            ([('created_at', ASCENDING)], dict(expireAfterSeconds=int(self.ttl.total_seconds()))),
+            ([('rule_id', ASCENDING), ('_id', DESCENDING)], dict(sparse=True)),
+            ([('recipients', ASCENDING), ('_id', DESCENDING)], dict()),
+        )
+        for keys, options in indexes:
+            try:
+                await self.collection.create_index(keys, background=True, **options)
+            except PyMongoError as err:
+                _log.error('Create delivery log index %r error: %r', keys, err)
+
+    def record(self, channel, recipients, status, rule_id=None, subject=None, error=None, **details):
+        """
+        Add delivery record to the buffer.
+        :param channel: delivery channel (email, sms, payment)
+        :param list recipients: e-mails, phones or urls
+        :param status: delivery status (sent, partial, failed, retry)
+        :param rule_id: notification rule id if delivery is made by the rule
+        :param subject: message subject
+        :param str error: error message
+        :param details: additional record fields
+        """
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+
+        entry = dict(details, created_at=datetime.utcnow(), channel=channel, recipients=list(recipients), status=status)
+        if rule_id is not None:
+            entry['rule_id'] = rule_id
+        if subject is not None:
+            entry['subject'] = subject
+        if error:
+            entry['error'] = error
+        self._buffer.append(entry)
+
+        if len(self._buffer) == self.batch_size:
+            self._schedule_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.max_delay, self._schedule_flush)
+
+    def _schedule_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def flush(self):
+        """ Insert all buffered records with one bulk insert. """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        records, self._buffer = self._buffer, []
+        if not records:
+            return
+
+        try:
+            await self.collection.insert(records, continue_on_error=True)
+            self.inserted += len(records)
+        except PyMongoError as err:
+            self.dropped += len(records)
+            _log.error('Delivery log insert error (%d records lost): %r', len(records), err)
+
+    async def close(self):
+        """ Flush buffered records and wait for running inserts. """
+        await self.flush()
+        if self._flush_tasks:
+            await asyncio.wait(list(self._flush_tasks))
+
+    async def find(self, rule_id=None, recipient=None, channel=None, status=None, before=None, limit=100):
+        """
+        Find delivery records, newest first.
+        Records are ordered by unique _id (ObjectId starts with creation time),
+        so records, created in the same millisecond, are not skipped between pages.
+        :param rule_id: notification rule id
+        :param recipient: recipient e-mail, phone or url
+        :param channel: delivery channel
+        :param status: delivery status
+        :param ObjectId before: cursor: return records with _id less than this id
+        :param int limit: maximum number of records
+        :return: list of records
+        """
+        spec = {}
+        if rule_id:
+            spec['rule_id'] = rule_id
+        if recipient:
+            spec['recipients'] = recipient
+        if channel:
+            spec['channel'] = channel
+        if status:
+            spec['status'] = status
+        if before:
+            spec['_id'] = {'$lt': before}
+
+        cursor = self.collection.find(spec).sort('_id', DESCENDING).limit(limit)
+        return await cursor.to_list(limit)
+
+
+def setup_audit_log(db):
+    """
+    Create delivery audit log from config and create its indexes.
+    :param db: motor database
+    :return: delivery audit log
+    """
+    global _audit_log
+    _audit_log = DeliveryAuditLog(
+        db[config.get('AUDIT_COLLECTION', 'deliveries')],
+        batch_size=config.get('AUDIT_BATCH_SIZE', 200),
+        max_delay=config.get('AUDIT_BATCH_DELAY_SEC', 1.0),
+        max_buffer=config.get('AUDIT_MAX_BUFFER', 10000),
+        ttl=config.get('AUDIT_TTL', timedelta(days=30))
+    )
+    asyncio.ensure_future(_audit_log.ensure_indexes())
+    return _audit_log
+
+
+async def close_audit_log():
+    """ Flush and close delivery audit log. """
+    global _audit_log
+    if _audit_log is not None:
+        await _audit_log.close()
+        _audit_log = None
+
+
+def get_audit_log():
+    return _audit_log
+
+
+def delivery_status(recipients, rejected):
+    """
+    Delivery status by rejected recipients.
+    :param recipients: all recipients
+    :param rejected: rejected recipients
+    :return: sent, partial or failed
+    """
+    if not rejected:
+        return 'sent'
+    return 'failed' if set(recipients) <= set(rejected) else 'partial'
+
+
+def record_delivery(channel, recipients, status, **kwargs):
+    """
+    Record delivery to the audit log (see DeliveryAuditLog.record).
+    Do nothing if audit log is not set up.
+    """
+    if _audit_log is not None:
+        _audit_log.record(channel, recipients, status, **kwargs)
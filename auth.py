@@ -1,3 +1,5 @@
+import asyncio
+import hashlib
 import logging
 import jwt
 import jwt.exceptions as jwt_err
@@ -5,13 +7,16 @@ from datetime import datetime
 from calendar import timegm
 from functools import wraps
 
+import cache
 import errors
+import metrics
 from config import config
 
 __author__ = 'Kostel Serhii'
 
 
 _log = logging.getLogger('xop.auth')
+_verified_tokens = None
 
 
 def _create_token(payload):
@@ -28,6 +33,70 @@ def _datetime_to_timestamp(dt_obj):
     return timegm(dt_obj.utctimetuple())
 
 
+# Verified tokens cache
+
+def _get_verified_tokens_cache():
+    global _verified_tokens
+    if _verified_tokens is None:
+        _verified_tokens = cache.TTLCache(
+            max_size=config.get('AUTH_TOKEN_CACHE_SIZE', 1024),
+            ttl=config.get('AUTH_TOKEN_CACHE_TTL_SEC', 300)
+        )
+    return _verified_tokens
+
+
+def verified_tokens_stats():
+    """
+    Verified tokens cache statistics.
+    :return: dict with cache hits, misses and size
+    """
+    tokens_cache = _get_verified_tokens_cache()
+    return dict(hits=tokens_cache.hits, misses=tokens_cache.misses, size=len(tokens_cache))
+
+
+metrics.gauge('notify_auth_token_cache_hits', 'Verified tokens cache hits').set_function(
+    lambda: verified_tokens_stats()['hits'])
+metrics.gauge('notify_auth_token_cache_misses', 'Verified tokens cache misses').set_function(
+    lambda: verified_tokens_stats()['misses'])
+metrics.gauge('notify_auth_token_cache_size', 'Verified tokens in cache').set_function(
+    lambda: verified_tokens_stats()['size'])
+
+
+def _decode_token(token, verify=True):
+    """
+    Decode and verify JWT token.
+    Verified tokens are cached by token digest until token (or session) expiration,
+    so signature is verified once per token.
+    :param token: JWT token
+    :param verify: True/False - raise error if token expired or not
+    :return: tuple (payload dict, frozenset with user groups)
+    :raise jwt.exceptions.InvalidTokenError: wrong or expired token
+    """
+    if not verify:
+        payload = jwt.decode(token, config['AUTH_KEY'], verify=False)
+        return payload, frozenset(payload.get('groups', []))
+
+    tokens_cache = _get_verified_tokens_cache()
+    token_key = hashlib.sha256(token.encode()).digest()
+
+    verified = tokens_cache.get(token_key)
+    if verified is not None:
+        return verified
+
+    payload = jwt.decode(token, config['AUTH_KEY'], verify=True)
+    groups = frozenset(payload.get('groups', []))
+
+    expiration = [payload['exp']] if 'exp' in payload else []
+    if 'system' not in groups:
+        expiration.append(payload.get('session_exp', 0))
+
+    now = _datetime_to_timestamp(datetime.utcnow())
+    ttl = min([tokens_cache.ttl] + [exp - now for exp in expiration])
+    tokens_cache.set(token_key, (payload, groups), ttl=ttl)
+
+    return payload, groups
+
+
 # Auth decorator
 
 def _check_authorization(request, access_groups, verify=True):
@@ -45,7 +114,7 @@ def _check_authorization(request, access_groups, verify=True):
         4. IP address
 
     :param request: Request instance with request information
-    :param access_groups: list of user groups, that has permissions to make request for current rule
+    :param frozenset access_groups: user groups, that has permissions to make request for current rule
     :param verify: True/False - raise error if token expired or not
     """
     token_header = request.headers.get('Authorization', '').split()
@@ -56,7 +125,7 @@ def _check_authorization(request, access_groups, verify=True):
         raise errors.UnauthorizedError('Token not found')
 
     try:
-        payload = jwt.decode(token, config['AUTH_KEY'], verify=verify)
+        payload, groups = _decode_token(token, verify=verify)
     except jwt_err.ExpiredSignatureError as err:
         _log.debug('Token expired: %r', err)
         raise errors.UnauthorizedError('Token expired')
@@ -64,10 +133,9 @@ def _check_authorization(request, access_groups, verify=True):
         _log.warning('Wrong token: %r', err)
         raise errors.UnauthorizedError('Wrong token')
 
-    groups = payload.get('groups', [])
     user_id = payload.get('user_id', '')
 
-    if not (set(groups) & set(access_groups)):
+    if groups.isdisjoint(access_groups):
         _log.warning('User %s not allowed to make such request. Need permissions: %r', user_id, access_groups)
         raise errors.ForbiddenError('Request forbidden for such role')
 
@@ -103,6 +171,8 @@ def auth(*access_groups, verify=True):
     :param access_groups: user groups, that has permissions to make request for current rule.
     :param verify: True/False - raise error if token expired or not
     """
+    access_groups = frozenset(access_groups)
+
     def auth_decorator(handler_method):
 
         @wraps(handler_method)
@@ -115,14 +185,67 @@ def auth(*access_groups, verify=True):
     return auth_decorator
 
 
+class SystemTokenProvider:
+    """
+    System token to communicate between internal services.
+    Signed token is reused until it is close to expiration
+    and refreshed in the background before it expires.
+    """
+
+    def __init__(self):
+        self.refresh_count = 0
+        self._token = None
+        self._refresh_at = None
+        self._refresh_task = None
+
+    def _refresh(self):
+        """ Sign new system token. """
+        now = datetime.utcnow()
+        payload = dict(
+            exp=now + config['AUTH_TOKEN_LIFE_TIME'],
+            user_id=config['AUTH_SYSTEM_USER_ID'],
+            groups=['system'],
+        )
+        self._token = _create_token(payload=payload)
+        self._refresh_at = now + config['AUTH_TOKEN_LIFE_TIME'] - config['AUTH_TOKEN_REFRESH_BEFORE']
+        self.refresh_count += 1
+        _log.debug('System token refreshed (%d)', self.refresh_count)
+
+    def get_token(self):
+        """
+        :return: system JWT token
+        """
+        if self._token is None or datetime.utcnow() >= self._refresh_at:
+            self._refresh()
+        return self._token
+
+    def start(self):
+        _log.info('Start system token refresh')
+        self._refresh_task = asyncio.ensure_future(self._refresh_loop())
+
+    def stop(self):
+        _log.info('Stop system token refresh')
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    async def _refresh_loop(self):
+        """ Refresh token before it expires. """
+        while True:
+            self.get_token()
+            timeout_sec = (self._refresh_at - datetime.utcnow()).total_seconds()
+            await asyncio.sleep(max(timeout_sec, 1))
+
+
+system_token = SystemTokenProvider()
+
+metrics.gauge('notify_auth_system_token_refreshes', 'System token refreshes since process start').set_function(
+    lambda: system_token.refresh_count)
+
+
 def get_system_token():
     """
     System token to communicate between internal services
     :return: system JWT token
     """
-    payload = dict(
-        exp=datetime.utcnow() + config['AUTH_TOKEN_LIFE_TIME'],
-        user_id=config['AUTH_SYSTEM_USER_ID'],
-        groups=['system'],
-    )
-    return _create_token(payload=payload)
+    return system_token.get_token()
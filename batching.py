@@ -0,0 +1,77 @@
+import asyncio
+import logging
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.batching')
+
+
+class MicroBatcher:
+    """
+    Collect keys from concurrent callers during a short time window
+    and resolve them with one bulk handler call.
+    Batch is flushed after max_delay seconds from the first key
+    or immediately when it reaches max_size keys.
+    """
+
+    def __init__(self, bulk_handler, max_delay=0.005, max_size=50):
+        """
+        :param bulk_handler: coroutine function, that gets list of keys
+            and returns dict with result for every key
+        :param max_delay: time window in seconds to collect keys
+        :param int max_size: maximum number of keys in one batch
+        """
+        self._bulk_handler = bulk_handler
+        self.max_delay = max_delay
+        self.max_size = max_size
+
+        self._pending = dict()
+        self._flush_handle = None
+
+    async def resolve(self, key):
+        """
+        Add key to the current batch and wait for its result.
+        The same key in one batch is resolved once.
+        :param key: key to resolve
+        :return: bulk handler result for the key
+        """
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.Future()
+            self._pending[key] = future
+
+            if len(self._pending) >= self.max_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = asyncio.get_event_loop().call_later(self.max_delay, self._flush)
+
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        """Send current batch to the bulk handler."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, dict()
+        if batch:
+            asyncio.ensure_future(self._resolve_batch(batch))
+
+    async def _resolve_batch(self, batch):
+        """
+        Resolve batch keys and fan results out to the waiting callers.
+        :param dict batch: futures by keys
+        """
+        try:
+            results = await self._bulk_handler(list(batch.keys()))
+        except Exception as err:
+            _log.exception('Bulk handler error: %r', err)
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        for key, future in batch.items():
+            if not future.done():
+                future.set_result(results.get(key))
@@ -0,0 +1,288 @@
+#!venv/bin/python
+"""
+End-to-end throughput benchmark.
+
+Run the service create_app wiring against local stand-ins in one process:
+in-process AMQP broker (replaces aioamqp.connect), SMTP sink, client and admin
+service stand-ins and in-memory MongoDB (mongomock). Publish the message mix
+to all four queues and report throughput, publish to ack latency and peak RSS.
+Runs offline, without RabbitMQ, MongoDB and SMTP server
+(install requirements-dev.txt or run make benchmark_e2e).
+
+    ./benchmarks/end_to_end.py --messages 20000 --mix request=60,email=20,sms=10,transaction=10
+    ./benchmarks/end_to_end.py --messages 5000 --rate 500 --rules 500 --json results.json
+"""
+import os
+import sys
+import json
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aioamqp
+
+import codec
+import app as service
+from config import config
+from generate_load import QUEUE_KEYS, STATUS_CODES, parse_mix, generate_message, sent_at_headers
+from standins import admin_service, client_service
+from standins.amqp_broker import InProcessBroker
+from standins.smtp_sink import SMTPSink
+from standins.mongo import create_database
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.benchmark')
+
+
+def generate_rules(count, rng):
+    """ Notification rules, that match part of the request messages. """
+    return [{
+        '_id': str(uuid.uuid4()),
+        'name': 'Benchmark rule %d' % i,
+        'case_regex': 'status: %d' % rng.choice(STATUS_CODES),
+        'case_template': 'status: {{ query.status_code }}',
+        'header_template': 'Request to {{ query.path }} finished with {{ query.status_code }}',
+        'body_template': 'Date {{ query.timestamp }}\nUser {{ user.name }} requested {{ query.path }} '
+                         'from {{ query.remote_address }}',
+        'subscribers_template': 'rule-%d@example.com, group:admin, store_managers:{{ query.store_id }}' % i,
+    } for i in range(count)]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LoadRun:
+    """ Publish messages to the broker and collect publish to ack latency. """
+
+    def __init__(self, broker, queue_names, weights, seed=0):
+        self.broker = broker
+        self.queue_names = queue_names
+        self.kinds = sorted(weights)
+        self.weights = [weights[kind] for kind in self.kinds]
+        self.rng = random.Random(seed)
+
+        self.pending = dict()
+        self.latencies = {kind: [] for kind in self.kinds}
+        self.published = {kind: 0 for kind in self.kinds}
+        self.publishing = True
+        self.done = asyncio.Event()
+
+    def on_ack(self, queue_name, message):
+        kind = self.pending.pop(message.message_id, None)
+        if kind is None:
+            return
+        self.latencies[kind].append(asyncio.get_event_loop().time() - message.published_at)
+        if not self.pending and not self.publishing:
+            self.done.set()
+
+    def publish_one(self, n):
+        kind = self._weighted_choice()
+        body = codec.dumps_bytes(generate_message(kind, n, self.rng))
+        message = self.broker.publish(self.queue_names[kind], body, properties={'delivery_mode': 2},
+                                      headers=sent_at_headers())
+        self.pending[message.message_id] = kind
+        self.published[kind] += 1
+
+    def _weighted_choice(self):
+        point = self.rng.uniform(0, sum(self.weights))
+        for kind, weight in zip(self.kinds, self.weights):
+            point -= weight
+            if point <= 0:
+                return kind
+        return self.kinds[-1]
+
+    async def publish(self, count, rate=0, burst=500):
+        """
+        Publish messages.
+        :param int count: number of messages
+        :param rate: messages per second. If 0 - publish as fast as possible in bursts
+        :param int burst: messages published without yielding to the loop
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        n = 0
+        while n < count:
+            if rate:
+                target = min(int((loop.time() - start) * rate) + 1, count)
+                while n < target:
+                    self.publish_one(n)
+                    n += 1
+                await asyncio.sleep(0.005)
+            else:
+                for _ in range(min(burst, count - n)):
+                    self.publish_one(n)
+                    n += 1
+                await asyncio.sleep(0)
+
+        self.publishing = False
+        if not self.pending:
+            self.done.set()
+
+
+async def start_server(loop, app_or_factory):
+    """ Start server on a free local port. :return: (server, port) """
+    factory = app_or_factory.make_handler() if hasattr(app_or_factory, 'make_handler') else app_or_factory
+    server = await loop.create_server(factory, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def wait_ready(broker, app, queue_names, timeout=30):
+    """ Wait until all queues are consumed and notification rules are loaded. """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        consumed = all(broker.consumers_count(name) for name in queue_names)
+        if consumed and app['notify_processor'].rule_set.version:
+            return
+        await asyncio.sleep(0.05)
+    raise TimeoutError('Service is not ready after %d sec' % timeout)
+
+
+async def run_benchmark(loop, args, weights):
+    rng = random.Random(args.seed)
+
+    admin_app = admin_service.create_app(loop=loop, emails_per_lookup=args.emails, latency=args.latency_ms / 1000)
+    client_app = client_service.create_app(loop=loop, latency=args.latency_ms / 1000)
+    smtp_sink = SMTPSink(latency=args.latency_ms / 1000)
+
+    admin_server, admin_port = await start_server(loop, admin_app)
+    client_server, client_port = await start_server(loop, client_app)
+    smtp_server = await smtp_sink.start(host='127.0.0.1', port=0, loop=loop)
+    smtp_port = smtp_server.sockets[0].getsockname()[1]
+
+    config.update(
+        ADMIN_BASE_URL='http://127.0.0.1:%d%s' % (admin_port, admin_service.URL_PREFIX),
+        CLIENT_BASE_URL='http://127.0.0.1:%d%s' % (client_port, client_service.URL_PREFIX),
+        MAIL_SERVER='127.0.0.1:%d' % smtp_port,
+        MAIL_USE_STARTTLS=False,
+        MAIL_USERNAME=None,
+        MAIL_PASSWORD=None,
+    )
+
+    queue_names = {kind: config[key] for kind, key in QUEUE_KEYS.items()}
+    broker = InProcessBroker()
+    aioamqp.connect = broker.connect
+
+    db = create_database(config['DB_NAME'])
+    await db.notifications.insert(generate_rules(args.rules, rng))
+
+    app = service.create_app(loop=loop, db=db)
+    await wait_ready(broker, app, queue_names.values())
+
+    run = LoadRun(broker, {kind: queue_names[kind] for kind in weights}, weights, seed=args.seed)
+    broker.on_ack = run.on_ack
+    rss_before = peak_rss_mb()
+
+    start = loop.time()
+    await run.publish(args.messages, rate=args.rate, burst=args.burst)
+    publish_time = loop.time() - start
+    try:
+        await asyncio.wait_for(run.done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        _log.error('Benchmark timeout: %d messages are not acked', len(run.pending))
+    total_time = loop.time() - start
+
+    all_latencies = sorted(latency for values in run.latencies.values() for latency in values)
+    results = dict(
+        messages=sum(run.published.values()),
+        acked=len(all_latencies),
+        publish_sec=round(publish_time, 3),
+        total_sec=round(total_time, 3),
+        messages_per_sec=round(len(all_latencies) / total_time, 1) if total_time else None,
+        latency_p50_ms=round(percentile(all_latencies, 0.5) * 1000, 2) if all_latencies else None,
+        latency_p99_ms=round(percentile(all_latencies, 0.99) * 1000, 2) if all_latencies else None,
+        rss_before_mb=round(rss_before, 1),
+        peak_rss_mb=round(peak_rss_mb(), 1),
+        queues={},
+        smtp_sink=smtp_sink.stats(),
+        admin_standin=dict(lookups=admin_app['standin'].lookups, bulk_requests=admin_app['standin'].bulk_requests),
+        client_standin=dict(updates=client_app['standin'].updates, errors=client_app['standin'].errors),
+        json_backend=codec.backend,
+        rules=args.rules,
+    )
+    for kind in sorted(run.latencies):
+        latencies = sorted(run.latencies[kind])
+        results['queues'][queue_names[kind]] = dict(
+            published=run.published[kind],
+            acked=len(latencies),
+            latency_p50_ms=round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            latency_p99_ms=round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        )
+
+    for server in (admin_server, client_server, smtp_server):
+        server.close()
+
+    return app, results
+
+
+def print_results(results):
+    print('Messages: %(messages)d published, %(acked)d acked in %(total_sec).2f sec '
+          '(published in %(publish_sec).2f sec)' % results)
+    print('Throughput: %s msg/s' % results['messages_per_sec'])
+    print('Publish to ack latency: p50 %s ms, p99 %s ms' % (results['latency_p50_ms'], results['latency_p99_ms']))
+    print('Peak RSS: %(peak_rss_mb).1f MB (%(rss_before_mb).1f MB before load)\n' % results)
+
+    print('%-22s %10s %10s %10s %10s' % ('queue', 'published', 'acked', 'p50, ms', 'p99, ms'))
+    for queue_name, stats in sorted(results['queues'].items()):
+        print('%-22s %10d %10d %10s %10s' % (queue_name, stats['published'], stats['acked'],
+                                             stats['latency_p50_ms'], stats['latency_p99_ms']))
+
+    print('\nSMTP sink: %r' % results['smtp_sink'])
+    print('Admin stand-in: %r' % results['admin_standin'])
+    print('Client stand-in: %r' % results['client_standin'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='XOPay Notify Service end-to-end benchmark.', allow_abbrev=False)
+    parser.add_argument('--config', default='debug', help='base config: [debug, production] (default "debug")')
+    parser.add_argument('--messages', type=int, default=10000, help='number of messages (default 10000)')
+    parser.add_argument('--mix', default='request=60,email=20,sms=10,transaction=10',
+                        help='message mix weights KIND=WEIGHT, kinds: request, email, sms, transaction '
+                             '(default request=60,email=20,sms=10,transaction=10)')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 - as fast as possible (default 0)')
+    parser.add_argument('--burst', type=int, default=500, help='messages per publish burst with --rate 0 (default 500)')
+    parser.add_argument('--rules', type=int, default=100, help='number of notification rules (default 100)')
+    parser.add_argument('--emails', type=int, default=3, help='e-mails for every directory lookup (default 3)')
+    parser.add_argument('--latency-ms', type=int, default=0, help='stand-ins response delay in ms (default 0)')
+    parser.add_argument('--timeout', type=float, default=300, help='max time to wait for acks in sec (default 300)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('--json', help='write results to the json file')
+    parser.add_argument('--log-level', default='ERROR', help='log level (default ERROR)')
+
+    args = parser.parse_args()
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as err:
+        parser.error(str(err))
+
+    config.load_config(args.config)
+    logging.basicConfig(format=config['LOG_FORMAT'], datefmt='%H:%M:%S', level=args.log_level)
+
+    loop = asyncio.get_event_loop()
+    app, results = loop.run_until_complete(run_benchmark(loop, args, weights))
+    loop.run_until_complete(service.shutdown(app))
+    loop.close()
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!venv/bin/python
+"""
+Compare JSON codec backends on representative queue payloads.
+Decode starts from AMQP body bytes, encode produces bytes for the wire.
+
+    ./benchmarks/json_codec.py --number 20000
+"""
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
+
+__author__ = 'Kostel Serhii'
+
+
+PAYLOADS = {
+    'transactions_status': {
+        'id': '0b5a5d3e-6a47-4b0c-9a4e-2f3d0d0b8f11',
+        'status': 'SUCCESS',
+        'redirect_url': 'https://shop.example.com/payment/complete?order=100500&lang=uk',
+    },
+    'notify_email': {
+        'email_to': 'merchant-0@example.com',
+        'subject': 'XOPAY: Payment received',
+        'text': 'Payment 0b5a5d3e-6a47-4b0c-9a4e-2f3d0d0b8f11 for 1250.00 UAH received.\n' * 8,
+    },
+    'notify_sms': {
+        'phone': '380501234567',
+        'text': 'XOPAY: payment 100500 succeeded',
+    },
+    'notify_request': {
+        'service_name': 'xopay-admin',
+        'user': {'id': '42', 'name': 'Serhii', 'groups': ['admin', 'manager'], 'session_exp': 1467294281},
+        'query': {
+            'path': '/api/admin/dev/stores/5f1e/merchants',
+            'method': 'POST',
+            'status_code': 401,
+            'remote_address': '10.0.0.17',
+            'timestamp': '2016-06-30T14:24:41.123456+00:00',
+            'args': {'limit': '100', 'after': 'a1b2c3'},
+            'headers': {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64)', 'Content-Type': 'application/json'},
+        },
+    },
+}
+
+
+def bench_backend(name, number):
+    """
+    Measure decode and encode time for every payload.
+    :return: dict {payload name: (decode usec, encode usec)}
+    """
+    codec.use(name)
+    results = {}
+    for payload_name, payload in PAYLOADS.items():
+        body = codec.dumps_bytes(payload)
+        decode = timeit.timeit(lambda: codec.loads(body), number=number)
+        encode = timeit.timeit(lambda: codec.dumps_bytes(payload), number=number)
+        results[payload_name] = (decode / number * 1e6, encode / number * 1e6)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='JSON codec backends benchmark.', allow_abbrev=False)
+    parser.add_argument('--number', type=int, default=20000, help='iterations per payload (default 20000)')
+    args = parser.parse_args()
+
+    default_backend = codec.backend
+    backends = codec.available_backends()
+    print('Available backends: %s (default: %s)\n' % (', '.join(backends), default_backend))
+
+    results = {name: bench_backend(name, args.number) for name in backends}
+    codec.use(default_backend)
+
+    print('%-20s %-10s %12s %12s %10s' % ('payload', 'backend', 'decode, us', 'encode, us', 'vs json'))
+    for payload_name in PAYLOADS:
+        base_decode, base_encode = results['json'][payload_name]
+        for name in backends:
+            decode, encode = results[name][payload_name]
+            speedup = (base_decode + base_encode) / (decode + encode)
+            print('%-20s %-10s %12.2f %12.2f %9.1fx' % (payload_name, name, decode, encode, speedup))
+        print()
+
+
+if __name__ == '__main__':
+    main()
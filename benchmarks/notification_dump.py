@@ -0,0 +1,81 @@
+#!venv/bin/python
+"""
+Compare notifications list serialization:
+new marshmallow schema per request, reused schema and fast dump.
+
+    ./benchmarks/notification_dump.py --rules 10000 --repeat 5
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
+from notification.handlers import NotificationSchema, _schemas, dump_notification
+
+__author__ = 'Kostel Serhii'
+
+
+def generate_notifications(count):
+    return [{
+        '_id': str(uuid.uuid4()),
+        'name': 'Template %d' % i,
+        'case_regex': 'status: 40[13]',
+        'case_template': 'status: {{ query.status_code }}',
+        'header_template': 'Prevented attempt to access {{ query.path }}',
+        'body_template': 'Date {{ query.timestamp }}\nUser {{ user.name }} try to access {{ query.path }}',
+        'subscribers_template': 'test@mail.me, group:admin, store:{{ query.store_id }}:managers',
+    } for i in range(count)]
+
+
+def schema_per_request(notifications):
+    return NotificationSchema(many=True).dump(notifications).data
+
+
+def reused_schema(notifications):
+    return _schemas.many.dump(notifications).data
+
+
+def fast_dump(notifications):
+    return [dump_notification(notification) for notification in notifications]
+
+
+def best_time(func, notifications, repeat):
+    """ Best of repeat runs: (dump seconds, dump + encode seconds). """
+    dump_times, total_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = func(notifications)
+        dumped = time.perf_counter()
+        codec.dumps_bytes({'notifications': data, 'next': None})
+        dump_times.append(dumped - start)
+        total_times.append(time.perf_counter() - start)
+    return min(dump_times), min(total_times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Notifications list serialization benchmark.', allow_abbrev=False)
+    parser.add_argument('--rules', type=int, default=10000, help='number of notifications (default 10000)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per variant, best is shown (default 5)')
+    args = parser.parse_args()
+
+    notifications = generate_notifications(args.rules)
+    assert fast_dump(notifications) == schema_per_request(notifications), 'Fast dump result differs from schema'
+
+    print('%d notifications, JSON backend: %s\n' % (args.rules, codec.backend))
+    print('%-20s %10s %16s %10s' % ('variant', 'dump, ms', 'dump+json, ms', 'vs schema'))
+
+    baseline = None
+    for name, func in (('schema per request', schema_per_request),
+                       ('reused schema', reused_schema),
+                       ('fast dump', fast_dump)):
+        dump_time, total_time = best_time(func, notifications, args.repeat)
+        baseline = baseline or total_time
+        print('%-20s %10.1f %16.1f %9.1fx' % (name, dump_time * 1000, total_time * 1000, baseline / total_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+#!venv/bin/python
+"""
+Rule engine benchmark.
+
+Build synthetic rule sets with NotifyProcessing.build_rule_set and run
+message corpus through the first processing stages (candidate_notify_nodes,
+rendered_notify_nodes, matched_notify_nodes), as request queue handler does.
+Report throughput, tracemalloc memory and allocated memory blocks
+per message for every rule set.
+Runs without MongoDB, RabbitMQ and SMTP server.
+
+    ./benchmarks/rule_engine.py --rules 10,100,1000,10000 --complexity simple,medium,complex
+    ./benchmarks/rule_engine.py --json after.json --compare before.json
+"""
+import gc
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import platform
+import argparse
+import itertools
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jinja2
+
+from notification.processing import NotifyProcessing
+
+__author__ = 'Kostel Serhii'
+
+
+# top-level message keys, rules and messages are spread over them
+NAMESPACES = ('query', 'payment', 'transfer', 'account', 'store', 'invoice', 'refund', 'payout')
+
+STATUS_CODES = (200, 201, 400, 401, 403, 404, 500, 503)
+METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+# complexity: case template without bucket suffix (NS is replaced with the rule namespace)
+CASE_TEMPLATES = dict(
+    simple='status: {{ NS.status_code }}',
+    medium='{{ NS.method|upper }} {{ NS.path|truncate(40, True) }} status: {{ NS.status_code }}',
+    complex='{% if NS.status_code >= 400 %}error{% else %}ok{% endif %} '
+            '{{ NS.path|replace("/", " ")|trim }} '
+            '{% for key, value in NS|dictsort %}{% if value is number %}{{ key }}={{ value }};{% endif %}{% endfor %}',
+)
+CASE_BUCKET_TEMPLATE = ' bucket: {{ NS.bucket }}'
+BUCKETS = 100
+
+
+def parse_list(value, item_type):
+    return [item_type(item.strip()) for item in value.split(',') if item.strip()]
+
+
+def case_regex(selectivity, rng):
+    """
+    Regex, that matches about selectivity part of the rendered cases.
+    Matches message bucket, so every rule has its own set of buckets.
+    """
+    count = int(round(selectivity * BUCKETS))
+    if not count:
+        return r'.* bucket: none$'
+    buckets = sorted(rng.sample(range(BUCKETS), count))
+    return r'.* bucket: (?:%s)$' % '|'.join(map(str, buckets))
+
+
+def generate_rules(count, complexity, selectivity, namespaces, rng):
+    """ Notification rules for the rule set. """
+    rules = []
+    for i in range(count):
+        ns = namespaces[i % len(namespaces)]
+        rules.append({
+            '_id': str(uuid.uuid4()),
+            'name': 'Benchmark rule %d' % i,
+            'case_regex': case_regex(selectivity, rng),
+            'case_template': (CASE_TEMPLATES[complexity] + CASE_BUCKET_TEMPLATE).replace('NS', ns),
+            'header_template': 'Request to {{ %s.path }} finished with {{ %s.status_code }}' % (ns, ns),
+            'body_template': 'User {{ user.name }} requested {{ %s.path }} at {{ %s.timestamp }}' % (ns, ns),
+            'subscribers_template': 'rule-%d@example.com, group:admin' % i,
+        })
+    return rules
+
+
+def generate_messages(count, namespaces, rng):
+    """ Request queue messages, every message has one of the namespaces. """
+    messages = []
+    for n in range(count):
+        store_id = 'store-%d' % rng.randrange(100)
+        messages.append({
+            'service_name': 'xopay-admin',
+            'user': {'id': str(n), 'name': 'user-%d' % rng.randrange(1000)},
+            rng.choice(namespaces): {
+                'path': '/api/admin/dev/stores/%s/payments/%d' % (store_id, rng.randrange(10 ** 6)),
+                'method': rng.choice(METHODS).lower(),
+                'status_code': rng.choice(STATUS_CODES),
+                'bucket': rng.randrange(BUCKETS),
+                'remote_address': '10.0.%d.%d' % (rng.randrange(256), rng.randrange(256)),
+                'timestamp': '2016-06-30T14:24:41.%06d' % n,
+            },
+        })
+    return messages
+
+
+def process_message(processor, message):
+    """ Candidate, render and match stages: (candidates, matched nodes). """
+    candidates = processor.candidate_notify_nodes(message)
+    rendered = list(processor.rendered_notify_nodes(message, candidates))
+    return candidates, list(processor.matched_notify_nodes(rendered))
+
+
+def measure_speed(processor, messages):
+    """ Stages time over all messages and nodes count. """
+    render_time = match_time = 0.0
+    candidates_count = matched_count = 0
+    perf_counter = time.perf_counter
+
+    for message in messages:
+        start = perf_counter()
+        candidates = processor.candidate_notify_nodes(message)
+        rendered = list(processor.rendered_notify_nodes(message, candidates))
+        rendered_at = perf_counter()
+        matched = list(processor.matched_notify_nodes(rendered))
+        render_time += rendered_at - start
+        match_time += perf_counter() - rendered_at
+
+        candidates_count += len(candidates)
+        matched_count += len(matched)
+
+    return render_time, match_time, candidates_count, matched_count
+
+
+def measure_memory(processor, messages):
+    """
+    tracemalloc memory per message: (mean peak bytes, mean retained bytes).
+    Peak is the high-water mark of memory allocated while message is processed,
+    retained is memory still allocated after the result is dropped (caches).
+    """
+    peak_total = retained_total = 0
+    tracemalloc.start()
+    try:
+        for message in messages:
+            tracemalloc.clear_traces()
+            result = process_message(processor, message)
+            del result
+            retained, peak = tracemalloc.get_traced_memory()
+            peak_total += peak
+            retained_total += retained
+    finally:
+        tracemalloc.stop()
+
+    return peak_total / len(messages), retained_total / len(messages)
+
+
+def measure_allocations(processor, messages):
+    """
+    Mean number of memory blocks per message, allocated by processing
+    and still alive, when the result is ready (sys.getallocatedblocks delta):
+    candidates set, rendered and matched nodes, cache growth.
+    Temporary blocks, freed before the stages return, are not counted.
+    Garbage collector is disabled, so it does not free unrelated blocks.
+    """
+    blocks_total = 0
+    gc.collect()
+    gc.disable()
+    try:
+        for message in messages:
+            before = sys.getallocatedblocks()
+            result = process_message(processor, message)
+            blocks_total += sys.getallocatedblocks() - before
+            del result
+    finally:
+        gc.enable()
+
+    return blocks_total / len(messages)
+
+
+def run_case(rules_count, complexity, selectivity, args):
+    rng = random.Random(args.seed)
+    namespaces = NAMESPACES[:args.namespaces]
+    rules = generate_rules(rules_count, complexity, selectivity, namespaces, rng)
+    messages = generate_messages(args.messages, namespaces, rng)
+
+    processor = NotifyProcessing(db=None, admin_base_url='http://127.0.0.1:7128/api/admin/dev',
+                                 template_cache_size=rules_count * 4)
+    start = time.perf_counter()
+    processor.build_rule_set(rules)
+    build_time = time.perf_counter() - start
+    assert len(processor.rule_set.nodes) == rules_count, 'Some rules are not compiled'
+
+    # warm up regex cache and template code paths
+    for message in messages[:args.warmup]:
+        process_message(processor, message)
+
+    best = None
+    for _ in range(args.repeat):
+        result = measure_speed(processor, messages)
+        if best is None or sum(result[:2]) < sum(best[:2]):
+            best = result
+    render_time, match_time, candidates_count, matched_count = best
+    total_time = render_time + match_time
+
+    peak_bytes, retained_bytes = measure_memory(processor, messages[:args.alloc_messages])
+    allocations = measure_allocations(processor, messages[:args.alloc_messages])
+
+    return dict(
+        rules=rules_count,
+        complexity=complexity,
+        selectivity=selectivity,
+        messages=len(messages),
+        build_sec=round(build_time, 4),
+        candidates_per_message=round(candidates_count / len(messages), 2),
+        matched_per_message=round(matched_count / len(messages), 2),
+        messages_per_sec=round(len(messages) / total_time, 1),
+        rendered_nodes_per_sec=round(candidates_count / render_time, 1) if render_time else None,
+        matched_nodes_per_sec=round(candidates_count / match_time, 1) if match_time else None,
+        render_us_per_message=round(render_time / len(messages) * 10 ** 6, 2),
+        match_us_per_message=round(match_time / len(messages) * 10 ** 6, 2),
+        peak_kb_per_message=round(peak_bytes / 1024, 2),
+        retained_bytes_per_message=round(retained_bytes, 1),
+        allocations_per_message=round(allocations, 1),
+    )
+
+
+def case_key(result):
+    return result['rules'], result['complexity'], result['selectivity']
+
+
+def git_revision():
+    """ Current commit hash or None outside of git repository. """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ResultsTable:
+    """ Print results row by row, as cases finish. """
+
+    header = ('rules', 'complexity', 'select', 'build s', 'cand/msg', 'match/msg',
+              'msg/s', 'render/s', 'match/s', 'peak KB', 'allocs')
+    row_format = '%7s %10s %7s %8s %9s %10s %10s %10s %10s %8s %8s'
+
+    def __init__(self, baseline=None):
+        """
+        :param baseline: previous results to compare messages per second or None
+        """
+        self.baseline = None
+        if baseline is not None:
+            self.baseline = {case_key(result): result for result in baseline['results']}
+            self.header += ('vs base',)
+            self.row_format += ' %8s'
+
+    def print_header(self, results):
+        print('Rule engine benchmark: commit %(commit)s, python %(python)s, jinja2 %(jinja2)s\n' % results)
+        print(self.row_format % self.header)
+
+    def print_row(self, result):
+        row = (result['rules'], result['complexity'], result['selectivity'], result['build_sec'],
+               result['candidates_per_message'], result['matched_per_message'], result['messages_per_sec'],
+               result['rendered_nodes_per_sec'], result['matched_nodes_per_sec'], result['peak_kb_per_message'],
+               result['allocations_per_message'])
+        if self.baseline is not None:
+            base = self.baseline.get(case_key(result))
+            row += ('%.2fx' % (result['messages_per_sec'] / base['messages_per_sec']) if base else '-',)
+        print(self.row_format % row, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='XOPay Notify Service rule engine benchmark.', allow_abbrev=False)
+    parser.add_argument('--rules', default='10,100,1000,10000',
+                        help='comma separated rule set sizes (default 10,100,1000,10000)')
+    parser.add_argument('--complexity', default='simple,medium,complex',
+                        help='comma separated case template complexity: %s (default all)' %
+                             ', '.join(sorted(CASE_TEMPLATES)))
+    parser.add_argument('--selectivity', default='0.1',
+                        help='comma separated part of rendered cases, that match rule regex (default 0.1)')
+    parser.add_argument('--namespaces', type=int, default=4,
+                        help='top-level message keys, rules are spread over (1-%d, default 4)' % len(NAMESPACES))
+    parser.add_argument('--messages', type=int, default=200, help='messages in the corpus (default 200)')
+    parser.add_argument('--repeat', type=int, default=2, help='runs over the corpus, best is shown (default 2)')
+    parser.add_argument('--warmup', type=int, default=20, help='warm up messages (default 20)')
+    parser.add_argument('--alloc-messages', type=int, default=50,
+                        help='messages to measure memory and allocated blocks (default 50)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('--json', help='write results to the json file')
+    parser.add_argument('--compare', help='json file with previous results to compare messages per second')
+    args = parser.parse_args()
+
+    try:
+        rules_counts = parse_list(args.rules, int)
+        selectivities = parse_list(args.selectivity, float)
+    except ValueError as err:
+        parser.error(str(err))
+    complexities = parse_list(args.complexity, str)
+    for complexity in complexities:
+        if complexity not in CASE_TEMPLATES:
+            parser.error('Unknown complexity "%s"' % complexity)
+    if not all(0 <= selectivity <= 1 for selectivity in selectivities):
+        parser.error('Selectivity must be between 0 and 1')
+    if not 1 <= args.namespaces <= len(NAMESPACES):
+        parser.error('Namespaces must be between 1 and %d' % len(NAMESPACES))
+    if args.messages < 1 or args.repeat < 1 or args.alloc_messages < 1:
+        parser.error('Messages, repeat and alloc messages must be positive')
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    logging.basicConfig(datefmt='%H:%M:%S', level='ERROR')
+
+    results = dict(
+        commit=git_revision(),
+        python=platform.python_version(),
+        jinja2=jinja2.__version__,
+        created_at=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        parameters=dict(namespaces=args.namespaces, messages=args.messages, repeat=args.repeat,
+                        warmup=args.warmup, alloc_messages=args.alloc_messages, seed=args.seed),
+        results=[],
+    )
+
+    table = ResultsTable(baseline)
+    table.print_header(results)
+    for rules_count, complexity, selectivity in itertools.product(rules_counts, complexities, selectivities):
+        result = run_case(rules_count, complexity, selectivity, args)
+        results['results'].append(result)
+        table.print_row(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+__author__ = 'Kostel Serhii'
+
+
+_missing = object()
+
+
+class TTLCache:
+    """
+    In-memory LRU cache with time to live for every entry.
+    Cache size is bounded: the least recently used entry
+    is removed when new entry does not fit.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        """
+        :param int max_size: maximum number of entries
+        :param ttl: default entry time to live in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._loading = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _missing, count=False) is not _missing
+
+    def get(self, key, default=None, count=True):
+        """
+        Return cached value or default if value is missing or expired.
+        :param key: cache key
+        :param default: value to return on cache miss
+        :param count: True - update hits and misses counters
+        """
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            expire_at, value = entry
+            if expire_at > time.monotonic():
+                self._entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            del self._entries[key]
+
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value in cache.
+        :param key: cache key
+        :param value: value to store
+        :param ttl: entry time to live in seconds. If None - use default
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            self._entries.pop(key, None)
+            return
+
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove entry from cache and return its value."""
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_load(self, key, loader, ttl_func=None):
+        """
+        Return cached value or load it with loader coroutine function.
+        Concurrent calls with the same missing key share one loader call.
+        :param key: cache key
+        :param loader: coroutine function without arguments, that returns value to store
+        :param ttl_func: function, that returns time to live for the loaded value. If None - use default
+        :return: cached or loaded value
+        """
+        value = self.get(key, _missing)
+        if value is not _missing:
+            return value
+
+        future = self._loading.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, loader, ttl_func))
+            self._loading[key] = future
+            future.add_done_callback(lambda f: self._loading.pop(key, None))
+
+        return await asyncio.shield(future)
+
+    async def _load(self, key, loader, ttl_func):
+        value = await loader()
+        self.set(key, value, ttl=ttl_func(value) if ttl_func else None)
+        return value
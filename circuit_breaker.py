@@ -0,0 +1,154 @@
+import time
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.circuit')
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the upstream service.
+
+    States:
+        closed - requests are allowed, results are collected in the sliding window.
+            Circuit opens, when failure rate in the window reaches the threshold.
+        open - requests fail fast. After open timeout circuit becomes half-open.
+            Late results of the requests, started before circuit opened, are ignored.
+        half-open - only probe requests are allowed.
+            Circuit closes after successful probes and opens again on probe failure.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_rate=0.5, window_size=20, min_calls=5, open_timeout=30, half_open_probes=1):
+        """
+        :param name: upstream name
+        :param failure_rate: failures part in the window to open circuit (0..1)
+        :param int window_size: number of last requests results to calculate failure rate
+        :param int min_calls: minimum number of results in the window to calculate failure rate
+        :param open_timeout: time in seconds before open circuit becomes half-open
+        :param int half_open_probes: number of successful probes to close circuit
+        """
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_timeout = open_timeout
+        self.half_open_probes = half_open_probes
+
+        self.state = self.CLOSED
+        self._window = deque(maxlen=window_size)
+        self._opened_at = 0
+        self._probes_in_flight = 0
+        self._probes_succeeded = 0
+
+    def _set_state(self, state):
+        if state != self.state:
+            _log.warning('Circuit %s: %s -> %s', self.name, self.state, state)
+        self.state = state
+
+    def _open(self):
+        self._set_state(self.OPEN)
+        self._opened_at = time.monotonic()
+        self._window.clear()
+
+    def _close(self):
+        self._set_state(self.CLOSED)
+        self._window.clear()
+
+    def allow_request(self):
+        """
+        Check if request to the upstream is allowed.
+        :return: True if request allowed, False - fail fast
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.open_timeout:
+                return False
+            self._set_state(self.HALF_OPEN)
+            self._probes_in_flight = 0
+            self._probes_succeeded = 0
+
+        if self.state == self.HALF_OPEN:
+            if self._probes_in_flight >= self.half_open_probes:
+                return False
+            self._probes_in_flight += 1
+
+        return True
+
+    def record_success(self):
+        if self.state == self.OPEN:
+            return
+
+        if self.state == self.HALF_OPEN:
+            self._probes_succeeded += 1
+            if self._probes_succeeded >= self.half_open_probes:
+                self._close()
+            return
+
+        self._window.append(True)
+
+    def release_probe(self):
+        """
+        Release half-open probe without result (e.g. request was cancelled),
+        so the other request can probe the upstream.
+        """
+        if self.state == self.HALF_OPEN and self._probes_in_flight > 0:
+            self._probes_in_flight -= 1
+
+    def record_failure(self):
+        if self.state == self.OPEN:
+            return
+
+        if self.state == self.HALF_OPEN:
+            self._open()
+            return
+
+        self._window.append(False)
+
+        if len(self._window) >= self.min_calls:
+            failures = self._window.count(False)
+            if failures / len(self._window) >= self.failure_rate:
+                self._open()
+
+
+class CircuitBreakerRegistry:
+    """
+    Circuit breakers by upstream.
+    Upstream is a known service base url or url scheme and network location.
+    """
+
+    def __init__(self, upstreams=None, **breaker_params):
+        """
+        :param dict upstreams: known services base urls by upstream names
+        :param breaker_params: CircuitBreaker parameters for every upstream
+        """
+        known_upstreams = ((name, base_url) for name, base_url in (upstreams or {}).items() if base_url)
+        self._upstreams = sorted(known_upstreams, key=lambda item: len(item[1]), reverse=True)
+        self._breaker_params = breaker_params
+        self._breakers = dict()
+
+    def __iter__(self):
+        return iter(self._breakers.values())
+
+    def for_url(self, url):
+        """
+        Get circuit breaker for the url upstream.
+        :param url: request url
+        :return: circuit breaker
+        """
+        upstream = next((name for name, base_url in self._upstreams if url.startswith(base_url)), None)
+        if upstream is None:
+            parts = urlsplit(url)
+            upstream = '%s://%s' % (parts.scheme, parts.netloc)
+
+        breaker = self._breakers.get(upstream)
+        if breaker is None:
+            breaker = CircuitBreaker(upstream, **self._breaker_params)
+            self._breakers[upstream] = breaker
+
+        return breaker
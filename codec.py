@@ -0,0 +1,112 @@
+"""
+JSON codec with the fastest available backend.
+
+Backend is selected at import time: orjson, ujson, rapidjson
+or the standard library json as fallback.
+All backends accept str or bytes to decode, so queue message
+bodies are decoded without intermediate str.
+"""
+import json
+import logging
+from collections import OrderedDict
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.codec')
+
+# Decode error of every backend is (or inherits) ValueError
+DecodeError = ValueError
+
+
+def _orjson_backend():
+    import orjson
+
+    def dumps_bytes(obj):
+        return orjson.dumps(obj)
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    return dumps, dumps_bytes, orjson.loads
+
+
+def _ujson_backend():
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+    def dumps_bytes(obj):
+        return dumps(obj).encode()
+
+    return dumps, dumps_bytes, ujson.loads
+
+
+def _rapidjson_backend():
+    import rapidjson
+
+    def dumps(obj):
+        return rapidjson.dumps(obj, ensure_ascii=False)
+
+    def dumps_bytes(obj):
+        return dumps(obj).encode()
+
+    return dumps, dumps_bytes, rapidjson.loads
+
+
+def _json_backend():
+
+    def dumps_bytes(obj):
+        return json.dumps(obj).encode()
+
+    def loads(data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode()
+        return json.loads(data)
+
+    return json.dumps, dumps_bytes, loads
+
+
+# backend name: backend factory, in order of preference
+BACKENDS = OrderedDict([
+    ('orjson', _orjson_backend),
+    ('ujson', _ujson_backend),
+    ('rapidjson', _rapidjson_backend),
+    ('json', _json_backend),
+])
+
+backend = None
+dumps = None
+dumps_bytes = None
+loads = None
+
+
+def use(name):
+    """
+    Switch codec to the backend.
+    :param name: backend name (one of BACKENDS keys)
+    :raise ImportError: backend library is not installed
+    """
+    global backend, dumps, dumps_bytes, loads
+    if name not in BACKENDS:
+        raise ValueError('Unknown JSON backend "%s". Use one of: %s' % (name, ', '.join(BACKENDS)))
+
+    dumps, dumps_bytes, loads = BACKENDS[name]()
+    backend = name
+    _log.debug('JSON codec backend: %s', name)
+
+
+def available_backends():
+    """ Names of the installed backends in order of preference. """
+    names = []
+    for name, factory in BACKENDS.items():
+        try:
+            factory()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+use(available_backends()[0])
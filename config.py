@@ -24,13 +24,76 @@ class _default:
     QUEUE_SMS = 'notify_sms'
     QUEUE_REQUEST = 'notify_request'
 
+    QUEUE_PREFETCH_COUNT = 20
+    QUEUE_MAX_CONCURRENCY = 10
+    QUEUE_ACK_BATCH_SIZE = 0
+    QUEUE_ACK_BATCH_DELAY_SEC = 0.2
+    QUEUE_TRANS_STATUS_RETRY_DELAYS = (1, 2, 4, 8, 16)
+    QUEUE_CONSUMER_OPTIONS = {
+        'transactions_status': dict(prefetch_count=50, max_concurrency=20, ack_batch_size=10),
+        'notify_email': dict(prefetch_count=20, max_concurrency=8),
+        'notify_sms': dict(prefetch_count=10, max_concurrency=4),
+        'notify_request': dict(prefetch_count=50, max_concurrency=20, ack_batch_size=10),
+    }
+
+    NOTIFY_TEMPLATE_CACHE_SIZE = 4096
+    NOTIFY_RULES_RELOAD_SEC = 30
+
+    # worker mode: worker processes by queue name (default: --workers argument)
+    QUEUE_WORKERS = {
+        'notify_request': 4,
+    }
+    WORKER_STOP_TIMEOUT_SEC = 30
+    # worker processes serve metrics on ports from this one (None - do not serve)
+    WORKER_METRICS_PORT = 7516
+
+    HTTP_CONNECTIONS_PER_HOST = 20
+    HTTP_KEEPALIVE_SEC = 30
+    HTTP_CONNECT_TIMEOUT_SEC = 5
+    HTTP_REQUEST_TIMEOUT_SEC = 10
+
+    CIRCUIT_FAILURE_RATE = 0.5
+    CIRCUIT_WINDOW_SIZE = 20
+    CIRCUIT_MIN_CALLS = 5
+    CIRCUIT_OPEN_SEC = 30
+    CIRCUIT_HALF_OPEN_PROBES = 1
+
+    DIRECTORY_CACHE_SIZE = 2048
+    DIRECTORY_CACHE_TTL_SEC = 300
+    DIRECTORY_CACHE_ERROR_TTL_SEC = 10
+
+    DIRECTORY_BULK_URL = '/emails/bulk'
+    DIRECTORY_BATCH_DELAY_MS = 5
+    DIRECTORY_BATCH_SIZE = 50
+
+    REPORT_DIGEST_WINDOW_SEC = 60
+    REPORT_DIGEST_MAX_ENTRIES = 1000
+    REPORT_DIGEST_MAX_SAMPLES = 10
+
+    AUDIT_COLLECTION = 'deliveries'
+    AUDIT_BATCH_SIZE = 200
+    AUDIT_BATCH_DELAY_SEC = 1.0
+    AUDIT_MAX_BUFFER = 10000
+    AUDIT_TTL = timedelta(days=30)
+
     CURRENCY_UPDATE_HOURS = (0, 6, 12, 18)
     CURRENCY_TIMEZONE = 'Europe/Riga'
 
     AUTH_ALGORITHM = 'HS512'
     AUTH_KEY = 'PzYs2qLh}2$8uUJbBnWB800iYKe5xdYqItRNo7@38yW@tPDVAX}EV5V31*ZK78QS'
     AUTH_TOKEN_LIFE_TIME = timedelta(minutes=30)
+    AUTH_TOKEN_REFRESH_BEFORE = timedelta(minutes=5)
     AUTH_SYSTEM_USER_ID = 'xopay.notify'
+    AUTH_TOKEN_CACHE_SIZE = 1024
+    AUTH_TOKEN_CACHE_TTL_SEC = 300
+
+    MAIL_USE_STARTTLS = True
+    MAIL_POOL_SIZE = 4
+    MAIL_CONNECTION_MAX_MESSAGES = 100
+    MAIL_KEEPALIVE_SEC = 30
+    MAIL_HEALTH_CHECK_SEC = 10
+    MAIL_TIMEOUT_SEC = 30
+    MAIL_RECIPIENTS_PER_TRANSACTION = 50
 
     LOG_BASE_NAME = 'xop'
     LOG_FORMAT = '%(levelname)-6.6s | NOTIFY | %(name)-12.12s | %(asctime)s | %(message)s'
@@ -2,10 +2,14 @@ import logging
 import asyncio
 import aiohttp
 import itertools
+from asyncio import TimeoutError
 from aiohttp.errors import ClientError
 from decimal import Decimal, getcontext
 from bs4 import BeautifulSoup, CData
 
+import utils
+from config import config
+
 __author__ = 'Kostel Serhii'
 
 
@@ -35,11 +39,10 @@ async def _get_page(url):
     """
     _log.debug('Load page url: %s', url)
     try:
-        with aiohttp.ClientSession() as session:
-            with aiohttp.Timeout(10):
-                async with session.get(url) as response:
-                    rest_status = response.status
-                    resp_body = await response.text()
+        with aiohttp.Timeout(config.get('HTTP_REQUEST_TIMEOUT_SEC', 10)):
+            async with utils.get_http_session().get(url) as response:
+                rest_status = response.status
+                resp_body = await response.text()
 
     except (TimeoutError, ClientError) as err:
         err_msg = 'HTTP Page Loader request error: %r' % err
@@ -1,7 +1,8 @@
-import json
 import logging
 from aiohttp import web
 
+import codec
+
 __author__ = 'Kostel Serhii'
 
 _log = logging.getLogger('xop.error')
@@ -43,7 +44,7 @@ class BaseApiError(web.HTTPClientError):
         if self.errors:
             error_dict['errors'] = self.errors
 
-        return json.dumps({'error': error_dict})
+        return codec.dumps({'error': error_dict})
 
 
 class ValidationError(BaseApiError):
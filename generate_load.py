@@ -0,0 +1,297 @@
+#!venv/bin/python
+"""
+Load generator for the notify queues.
+
+Publish synthetic transactions_status, notify_email, notify_sms and notify_request
+messages to the AMQP broker at a target rate or in open-loop bursts
+(bursts are published on schedule, regardless of the consumers progress).
+Every message has x-sent-at header with the publish time (unix timestamp),
+service measures queue to handler latency from it (notify_queue_latency_seconds).
+Latency is computed with the wall clocks of both hosts, keep them in sync.
+
+Transaction status messages update payments on the client service (PUT),
+so they need ids of the existing payments (--payment-ids file, one id per line).
+Without it transaction messages get random ids: every update fails and is retried
+through the delay queues, so transaction is not in the default mix.
+
+    ./generate_load.py --rate 200 --duration 60
+    ./generate_load.py --burst 1000 --interval 5 --messages 20000 --mix request=100
+    ./generate_load.py --duration 60 --mix request=60,transaction=40 --payment-ids payments.txt
+    ./generate_load.py --host 127.0.0.1 --username guest --password guest --vhost /
+"""
+import time
+import uuid
+import random
+import signal
+import asyncio
+import logging
+import argparse
+
+import aioamqp
+
+import codec
+from config import config
+from message_queue.connect import SENT_AT_HEADER
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.load')
+
+# message kind: queue name config key
+QUEUE_KEYS = dict(request='QUEUE_REQUEST', email='QUEUE_EMAIL', sms='QUEUE_SMS', transaction='QUEUE_TRANS_STATUS')
+
+STATUS_CODES = (200, 201, 400, 401, 403, 404, 500, 503)
+
+
+def parse_mix(mix):
+    """
+    Parse message mix weights.
+    :param str mix: comma separated KIND=WEIGHT (e.g. request=60,email=20)
+    :return: dict {kind: weight}
+    :raise ValueError: wrong mix
+    """
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.strip().partition('=')
+        if kind not in QUEUE_KEYS or not weight.isdigit():
+            raise ValueError('Wrong mix item "%s". Use KIND=WEIGHT, where KIND is one of: %s' %
+                             (item, ', '.join(sorted(QUEUE_KEYS))))
+        weights[kind] = int(weight)
+    if not sum(weights.values()):
+        raise ValueError('Mix weights sum must be positive')
+    return weights
+
+
+def read_payment_ids(path):
+    """
+    Read payment ids for transaction status messages.
+    :param path: text file with one payment id per line
+    :return: list with payment ids
+    :raise ValueError: file has no payment ids
+    """
+    with open(path) as f:
+        payment_ids = [line.strip() for line in f if line.strip()]
+    if not payment_ids:
+        raise ValueError('No payment ids in the file %s' % path)
+    return payment_ids
+
+
+def generate_message(kind, n, rng, payment_ids=None):
+    """
+    Queue message of the kind.
+    :param kind: message kind (see QUEUE_KEYS)
+    :param int n: message number
+    :param rng: random generator
+    :param list payment_ids: ids of the existing payments for transaction messages.
+        If None - random ids (client service rejects them)
+    """
+    if kind == 'request':
+        store_id = 'store-%d' % rng.randrange(100)
+        return {
+            'service_name': 'xopay-admin',
+            'user': {'id': str(n), 'name': 'user-%d' % rng.randrange(1000)},
+            'query': {
+                'path': '/api/admin/dev/stores/%s' % store_id,
+                'store_id': store_id,
+                'status_code': rng.choice(STATUS_CODES),
+                'remote_address': '10.0.%d.%d' % (rng.randrange(256), rng.randrange(256)),
+                'timestamp': '2016-06-30T14:24:41.%06d' % n,
+            },
+        }
+    if kind == 'email':
+        return {'email_to': 'user-%d@example.com' % rng.randrange(1000),
+                'subject': 'Benchmark message %d' % n,
+                'text': 'Benchmark message %d body.\n' % n * 10}
+    if kind == 'sms':
+        return {'phone': '38050%07d' % rng.randrange(10 ** 7), 'text': 'Benchmark sms %d' % n}
+    payment_id = rng.choice(payment_ids) if payment_ids else str(uuid.uuid4())
+    return {'id': payment_id, 'status': 'SUCCESS', 'redirect_url': 'https://shop.example.com/order/%d' % n}
+
+
+def sent_at_headers():
+    """
+    Message headers with the current publish time.
+    AMQP tables of the aioamqp client have no float type, so time is sent as string.
+    """
+    return {SENT_AT_HEADER: '%.6f' % time.time()}
+
+
+class LoadGenerator:
+    """ Publish weighted mix of the messages to the notify queues. """
+
+    def __init__(self, channel, queue_names, weights, seed=0, payment_ids=None):
+        """
+        :param channel: aioamqp channel
+        :param dict queue_names: {kind: queue name}
+        :param dict weights: {kind: weight}
+        :param seed: random seed
+        :param list payment_ids: ids of the existing payments for transaction messages
+        """
+        self.channel = channel
+        self.queue_names = queue_names
+        self.payment_ids = payment_ids
+        self.kinds = sorted(weights)
+        self.weights = [weights[kind] for kind in self.kinds]
+        self.rng = random.Random(seed)
+
+        self.published = {kind: 0 for kind in self.kinds}
+        self.max_lag = 0.0
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    def _weighted_choice(self):
+        point = self.rng.uniform(0, sum(self.weights))
+        for kind, weight in zip(self.kinds, self.weights):
+            point -= weight
+            if point <= 0:
+                return kind
+        return self.kinds[-1]
+
+    async def publish_one(self, n):
+        kind = self._weighted_choice()
+        body = codec.dumps_bytes(generate_message(kind, n, self.rng, self.payment_ids))
+        await self.channel.publish(body, exchange_name='', routing_key=self.queue_names[kind],
+                                   properties={'delivery_mode': 2, 'headers': sent_at_headers()})
+        self.published[kind] += 1
+
+    def _finished(self, n, count, deadline):
+        loop = asyncio.get_event_loop()
+        return self._stopped or (count and n >= count) or (deadline and loop.time() >= deadline)
+
+    async def run(self, count=0, duration=0, rate=0, burst=0, interval=1.0):
+        """
+        Publish messages until count or duration limit is reached (or stop is called).
+        Messages are sent on schedule, publish delay behind schedule is kept in max_lag.
+        :param int count: number of messages. If 0 - not limited
+        :param duration: publish time in seconds. If 0 - not limited
+        :param rate: messages per second. If 0 - as fast as possible
+        :param int burst: messages in the burst, published every interval seconds. If 0 - use rate
+        :param interval: time between bursts in seconds
+        :return: publish time in seconds
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        deadline = start + duration if duration else None
+        n = 0
+
+        while not self._finished(n, count, deadline):
+            if burst:
+                scheduled = start + n // burst * interval
+                size = burst if not count else min(burst, count - n)
+            else:
+                scheduled = start + n / rate if rate else loop.time()
+                size = 1
+
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if self._finished(n, count, deadline):
+                    break
+            self.max_lag = max(self.max_lag, loop.time() - scheduled)
+
+            for _ in range(size):
+                await self.publish_one(n)
+                n += 1
+
+        return loop.time() - start
+
+
+async def run_load(args, weights, payment_ids=None):
+    queue_names = {kind: config[key] for kind, key in QUEUE_KEYS.items() if kind in weights}
+
+    transport, protocol = await aioamqp.connect(host=args.host, port=args.port, login=args.username,
+                                                password=args.password, virtualhost=args.vhost)
+    _log.info('Connected to the AMQP broker %s:%d%s', args.host, args.port, args.vhost)
+    try:
+        channel = await protocol.channel()
+        for queue_name in queue_names.values():
+            await channel.queue_declare(queue_name=queue_name, durable=True)
+
+        generator = LoadGenerator(channel, queue_names, weights, seed=args.seed, payment_ids=payment_ids)
+        loop = asyncio.get_event_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, generator.stop)
+
+        publish_time = await generator.run(count=args.messages, duration=args.duration, rate=args.rate,
+                                           burst=args.burst, interval=args.interval)
+    finally:
+        await protocol.close()
+        transport.close()
+
+    return generator, queue_names, publish_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='XOPay Notify Service queues load generator.', allow_abbrev=False)
+    parser.add_argument('--config', default='debug', help='config with broker parameters: [debug, production] '
+                                                          '(default "debug")')
+    parser.add_argument('--host', help='broker host (default QUEUE_HOST from config)')
+    parser.add_argument('--port', type=int, help='broker port (default QUEUE_PORT from config)')
+    parser.add_argument('--username', help='broker username (default QUEUE_USERNAME from config)')
+    parser.add_argument('--password', help='broker password (default QUEUE_PASSWORD from config)')
+    parser.add_argument('--vhost', help='broker virtual host (default QUEUE_VIRTUAL_HOST from config)')
+    parser.add_argument('--mix', default='request=70,email=20,sms=10',
+                        help='message mix weights KIND=WEIGHT, kinds: request, email, sms, transaction '
+                             '(default request=70,email=20,sms=10)')
+    parser.add_argument('--payment-ids', metavar='FILE',
+                        help='file with existing payment ids (one per line) for transaction messages')
+    parser.add_argument('--messages', type=int, default=0, help='number of messages, 0 - not limited (default 0)')
+    parser.add_argument('--duration', type=float, default=0, help='publish time in sec, 0 - not limited (default 0)')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='messages per second, 0 - as fast as possible (default 100)')
+    parser.add_argument('--burst', type=int, default=0,
+                        help='publish bursts of messages every --interval sec instead of --rate (default 0)')
+    parser.add_argument('--interval', type=float, default=1.0, help='time between bursts in sec (default 1)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+    parser.add_argument('--log-level', default='INFO', help='log level (default INFO)')
+
+    args = parser.parse_args()
+    try:
+        weights = parse_mix(args.mix)
+    except ValueError as err:
+        parser.error(str(err))
+    if not args.messages and not args.duration:
+        parser.error('Set --messages or --duration limit')
+    if args.rate < 0 or args.burst < 0 or args.interval <= 0:
+        parser.error('Rate and burst must not be negative, interval must be positive')
+
+    payment_ids = None
+    if args.payment_ids:
+        try:
+            payment_ids = read_payment_ids(args.payment_ids)
+        except (OSError, ValueError) as err:
+            parser.error(str(err))
+
+    config.load_config(args.config)
+    logging.basicConfig(format=config['LOG_FORMAT'], datefmt='%Y-%m-%d %H:%M:%S', level=args.log_level)
+
+    if weights.get('transaction') and payment_ids is None:
+        _log.warning('Transaction messages without --payment-ids have random ids, client service rejects them')
+
+    args.host = args.host or config['QUEUE_HOST']
+    args.port = args.port or config['QUEUE_PORT']
+    args.username = args.username or config['QUEUE_USERNAME']
+    args.password = args.password or config['QUEUE_PASSWORD']
+    args.vhost = args.vhost or config['QUEUE_VIRTUAL_HOST']
+
+    loop = asyncio.get_event_loop()
+    try:
+        generator, queue_names, publish_time = loop.run_until_complete(run_load(args, weights, payment_ids))
+    except (aioamqp.AioamqpException, OSError) as err:
+        _log.error('AMQP broker %s:%d error: %r', args.host, args.port, err)
+        raise SystemExit(1)
+    finally:
+        loop.close()
+
+    total = sum(generator.published.values())
+    print('Published %d messages in %.2f sec (%.1f msg/s), max lag behind schedule %.1f ms' %
+          (total, publish_time, total / publish_time if publish_time else 0, generator.max_lag * 1000))
+    for kind in generator.kinds:
+        print('%-22s %10d' % (queue_names[kind], generator.published[kind]))
+
+
+if __name__ == '__main__':
+    main()
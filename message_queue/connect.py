@@ -1,14 +1,32 @@
+import time
 import logging
 import aioamqp
 import asyncio
-import json
-from json.decoder import JSONDecodeError
+from collections import OrderedDict
+
+import codec
+import metrics
 
 __author__ = 'Kostel Serhii'
 
 
 _log = logging.getLogger('xop.queue')
 
+_messages_received = metrics.counter('notify_queue_messages_received_total', 'Messages received', ('queue',))
+_messages_acked = metrics.counter('notify_queue_messages_acked_total', 'Messages acked', ('queue',))
+_messages_retried = metrics.counter('notify_queue_messages_retried_total', 'Messages sent to retry', ('queue',))
+_messages_failed = metrics.counter('notify_queue_messages_failed_total',
+                                   'Messages with decode or handler errors', ('queue',))
+_messages_in_progress = metrics.gauge('notify_queue_messages_in_progress', 'Messages received, not acked', ('queue',))
+_handler_seconds = metrics.histogram('notify_queue_handler_seconds', 'Queue message handler latency', ('queue',))
+_latency_seconds = metrics.histogram('notify_queue_latency_seconds',
+                                     'Time from message publish (x-sent-at header) to handler start', ('queue',),
+                                     buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                                              10.0, 30.0, 60.0, 300.0))
+
+# publisher wall clock time (unix timestamp in seconds) of the message, see generate_load.py
+SENT_AT_HEADER = 'x-sent-at'
+
 
 class _QueueConnect(object):
     """
@@ -120,60 +138,414 @@ class _QueueConnect(object):
         self._reconnect_timeout_sec = self.MIN_RECONNECT_TIMEOUT_SEC
 
 
+class RetryLater(Exception):
+    """
+    Raise in queue handler to retry message later.
+    Message is republished to the broker delay queue of the next attempt.
+    """
+    pass
+
+
+def retry_queue_name(queue_name, attempt):
+    return '%s.retry.%d' % (queue_name, attempt)
+
+
+def message_sent_at(properties):
+    """
+    Publish time of the first message delivery from the x-sent-at header.
+    Retried messages are skipped, their latency includes retry delay.
+    :param properties: aioamqp message properties
+    :return: unix timestamp in seconds or None
+    """
+    headers = getattr(properties, 'headers', None)
+    if not headers or 'x-retry-attempt' in headers:
+        return None
+    try:
+        return float(headers[SENT_AT_HEADER])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class _AckBatcher:
+    """
+    Batch acknowledgements of the channel deliveries.
+    Completed deliveries are acknowledged with one ack (multiple=True)
+    up to the highest contiguous completed delivery tag,
+    so handlers may complete out of order.
+    Batch is flushed when max_count deliveries completed or after max_delay seconds.
+    If the oldest delivery is not completed for more than max_delay seconds
+    (e.g. slow handler), deliveries completed after it are acked separately.
+    """
+
+    def __init__(self, channel, max_count=50, max_delay=0.2):
+        """
+        :param channel: aioamqp channel
+        :param int max_count: number of completed deliveries to flush acks
+        :param max_delay: maximum delay in seconds before acks flush
+        """
+        self._channel = channel
+        self.max_count = max_count
+        self.max_delay = max_delay
+
+        self._delivered = OrderedDict()
+        self._completed = set()
+        self._completed_count = 0
+        self._flush_handle = None
+        self._cancelled = False
+
+    def delivered(self, delivery_tag):
+        """ Register received delivery (in the channel delivery order). """
+        self._delivered[delivery_tag] = asyncio.get_event_loop().time()
+
+    async def complete(self, delivery_tag):
+        """ Mark delivery as handled and flush acks if batch is full. """
+        if self._cancelled:
+            return
+
+        self._completed.add(delivery_tag)
+        self._completed_count += 1
+
+        if self._completed_count >= self.max_count:
+            await self.flush()
+        elif self._flush_handle is None:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        """ Flush acks after max delay. """
+        loop = asyncio.get_event_loop()
+        self._flush_handle = loop.call_later(self.max_delay, lambda: asyncio.ensure_future(self._delayed_flush()))
+
+    async def _delayed_flush(self):
+        """ Flush acks from the timer, nobody awaits it to handle errors. """
+        try:
+            await self.flush()
+        except aioamqp.AioamqpException as err:
+            _log.error('Queue acks flush error: %r', err)
+
+    async def flush(self):
+        """ Ack all deliveries up to the highest contiguous completed delivery tag. """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        last_tag = None
+        for delivery_tag in self._delivered:
+            if delivery_tag not in self._completed:
+                break
+            last_tag = delivery_tag
+
+        if last_tag is not None:
+            while True:
+                delivery_tag, _ = self._delivered.popitem(last=False)
+                self._completed.discard(delivery_tag)
+                if delivery_tag == last_tag:
+                    break
+            self._completed_count = len(self._completed)
+
+            _log.debug('Send messages ack up to #%s', last_tag)
+            await self._channel.basic_client_ack(delivery_tag=last_tag, multiple=True)
+
+        if self._completed and self._delivered:
+            head_delivered_at = next(iter(self._delivered.values()))
+            if asyncio.get_event_loop().time() - head_delivered_at >= self.max_delay:
+                await self._ack_completed_separately()
+
+        if self._completed and self._flush_handle is None:
+            self._schedule_flush()
+
+    async def abandon(self, delivery_tag):
+        """
+        Forget delivery, that is settled without ack (e.g. nacked),
+        so it does not block acks of the following deliveries.
+        """
+        if self._delivered.pop(delivery_tag, None) is None:
+            return
+        if delivery_tag in self._completed:
+            self._completed.discard(delivery_tag)
+            self._completed_count = len(self._completed)
+
+        if self._completed:
+            await self.flush()
+
+    def cancel(self):
+        """
+        Drop pending acks without sending them, when channel is closed
+        (e.g. on reconnect). Delivery tags are valid only in their channel,
+        the broker redelivers unacked messages.
+        """
+        self._cancelled = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        self._delivered.clear()
+        self._completed.clear()
+        self._completed_count = 0
+
+    async def close(self):
+        """
+        Flush all completed deliveries.
+        Deliveries completed after the uncompleted one are acked separately.
+        """
+        await self.flush()
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        await self._ack_completed_separately()
+
+    async def _ack_completed_separately(self):
+        """
+        Ack every completed delivery with its own ack (multiple=False),
+        so uncompleted deliveries before them stay unacked.
+        """
+        completed, self._completed = sorted(self._completed), set()
+        self._completed_count = 0
+        for delivery_tag in completed:
+            del self._delivered[delivery_tag]
+        for delivery_tag in completed:
+            _log.debug('Send message #%s ack', delivery_tag)
+            await self._channel.basic_client_ack(delivery_tag=delivery_tag)
+
+
 class QueueListener(_QueueConnect):
     """
     Async RabbitMQ listener (consumer)
     """
+
+    DEFAULT_PREFETCH_COUNT = 20
+    DEFAULT_MAX_CONCURRENCY = 10
+    CLOSE_TIMEOUT_SEC = 10
+
     def __init__(self, queue_handlers, connect_parameters=None):
         """
         Create RabbitMQ Async Queue Listener
         :param list queue_handlers: list with tuples (queue_name, async on_msg_callback)
+            or (queue_name, async on_msg_callback, options dict). Options:
+                prefetch_count - maximum number of unacknowledged messages
+                max_concurrency - maximum number of concurrently running handlers
+                ack_batch_size - number of completed messages to ack at once (0 - ack every message)
+                ack_batch_delay - maximum delay in seconds before batched ack
+                retry_delays - delays in seconds for every retry attempt (handler raises RetryLater)
+                retry_failed_callback - async callback(message, error, attempts) when retries exhausted
         :param dict connect_parameters: dict with keys: host, port, login, password, virtualhost
         """
         self._queue_handlers = queue_handlers
+        self._handler_tasks = set()
+        self._handler_semaphores = {}
+        self._ack_batchers = []
         super().__init__(connect_parameters)
 
+    def _get_queue_options(self, options):
+        """ Merge queue handler options with defaults. """
+        connect_params = self._connect_params or {}
+        queue_options = dict(
+            prefetch_count=connect_params.get('QUEUE_PREFETCH_COUNT', self.DEFAULT_PREFETCH_COUNT),
+            max_concurrency=connect_params.get('QUEUE_MAX_CONCURRENCY', self.DEFAULT_MAX_CONCURRENCY),
+            ack_batch_size=connect_params.get('QUEUE_ACK_BATCH_SIZE', 0),
+            ack_batch_delay=connect_params.get('QUEUE_ACK_BATCH_DELAY_SEC', 0.2),
+            retry_delays=(),
+            retry_failed_callback=None,
+        )
+        queue_options.update(options or {})
+        return queue_options
+
     async def _chanel_connection(self):
         """ Declare queues and register on message callback handlers """
 
         if not self._transport or not self._protocol:
             raise Exception('Queue connection missing')
 
-        for queue_name, on_msg_callback in self._queue_handlers:
-            callback = self._wrap_on_msg_callback_with_ack(on_msg_callback)
+        for ack_batcher in self._ack_batchers:
+            ack_batcher.cancel()
+        self._ack_batchers = []
+
+        for queue_name, on_msg_callback, *options in self._queue_handlers:
+            queue_options = self._get_queue_options(options[0] if options else None)
 
             channel = await self._protocol.channel()
+
+            ack_batcher = None
+            if queue_options['ack_batch_size'] > 1:
+                ack_batcher = _AckBatcher(channel, queue_options['ack_batch_size'], queue_options['ack_batch_delay'])
+                self._ack_batchers.append(ack_batcher)
+
+            callback = self._wrap_on_msg_callback_with_ack(on_msg_callback, queue_name, queue_options, ack_batcher)
+
             await channel.queue_declare(queue_name=queue_name, durable=True)
+            await self._declare_retry_queues(channel, queue_name, queue_options['retry_delays'])
+            await channel.basic_qos(prefetch_count=queue_options['prefetch_count'], prefetch_size=0,
+                                    connection_global=False)
             await channel.basic_consume(callback, queue_name=queue_name)
 
+            _log.info('Consume queue %s (prefetch: %d, concurrency: %d)', queue_name,
+                      queue_options['prefetch_count'], queue_options['max_concurrency'])
+
+    @staticmethod
+    async def _declare_retry_queues(channel, queue_name, retry_delays):
+        """
+        Declare delay queue for every retry attempt.
+        Messages wait in the delay queue for the attempt delay (message TTL)
+        and return to the source queue through the default exchange dead-letter routing.
+        """
+        for attempt, delay in enumerate(retry_delays, start=1):
+            await channel.queue_declare(
+                queue_name=retry_queue_name(queue_name, attempt),
+                durable=True,
+                arguments={
+                    'x-message-ttl': int(delay * 1000),
+                    'x-dead-letter-exchange': '',
+                    'x-dead-letter-routing-key': queue_name,
+                }
+            )
+
+    @staticmethod
+    async def _retry_message(channel, queue_name, queue_options, message, body, properties, error):
+        """
+        Publish message to the delay queue of the next attempt
+        or call retry failed callback if all attempts are used.
+        Attempt number is carried in the message headers.
+        """
+        headers = dict(getattr(properties, 'headers', None) or {})
+        attempt = int(headers.get('x-retry-attempt', 0)) + 1
+        retry_delays = queue_options['retry_delays']
+
+        if attempt > len(retry_delays):
+            _log.critical('Queue %s message retries exhausted (%d attempts): %s', queue_name, attempt - 1, error)
+            retry_failed_callback = queue_options['retry_failed_callback']
+            if retry_failed_callback is not None:
+                try:
+                    await retry_failed_callback(message, error, attempt - 1)
+                except Exception as err:
+                    _log.exception('Queue %s retry failed callback error: %r', queue_name, err)
+            return
+
+        headers.update({'x-retry-attempt': attempt, 'x-retry-error': str(error)[:255]})
+        _log.info('Retry queue %s message after %s sec (attempt: %d/%d)',
+                  queue_name, retry_delays[attempt - 1], attempt, len(retry_delays))
+
+        await channel.publish(body, exchange_name='', routing_key=retry_queue_name(queue_name, attempt),
+                              properties={'headers': headers, 'delivery_mode': 2})
+
     @staticmethod
-    def _wrap_on_msg_callback_with_ack(callback):
+    async def _requeue_message(channel, delivery_tag, ack_batcher=None):
+        """
+        Return message to the queue (nack with requeue) and
+        remove it from the acks batch. Nack is sent first,
+        so batched ack (multiple=True) never covers this delivery.
+        """
+        try:
+            await channel.basic_client_nack(delivery_tag=delivery_tag, requeue=True)
+        except aioamqp.AioamqpException as err:
+            _log.error('Queue message #%s nack error: %r', delivery_tag, err)
+
+        if ack_batcher is not None:
+            await ack_batcher.abandon(delivery_tag)
+
+    def _wrap_on_msg_callback_with_ack(self, callback, queue_name, queue_options, ack_batcher=None):
         """
         Get on message callback function, make it async and
         wrap with basic queue ack after function end.
         Decode queue message body to json dict.
+        Every message is handled in the separate task,
+        number of concurrently running handlers is limited with the queue semaphore,
+        that is kept between reconnects, so handlers of the old channel are counted too.
+        If handler raises RetryLater - message is republished to the delay queue before ack
+        (or requeued with nack, if republish fails).
 
         :param callback: on message handler
+        :param queue_name: consumed queue name
+        :param dict queue_options: queue options (see QueueListener)
+        :param ack_batcher: channel acks batcher. If None - ack every message separately
         :return: async callback with ack
         """
         if not asyncio.iscoroutinefunction(callback):
             callback = asyncio.coroutine(callback)
 
+        semaphore = self._handler_semaphores.get(queue_name)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(queue_options['max_concurrency'])
+            self._handler_semaphores[queue_name] = semaphore
+
+        received = _messages_received.labels(queue_name)
+        acked = _messages_acked.labels(queue_name)
+        retried = _messages_retried.labels(queue_name)
+        failed = _messages_failed.labels(queue_name)
+        in_progress = _messages_in_progress.labels(queue_name)
+        handler_seconds = _handler_seconds.labels(queue_name)
+        latency_seconds = _latency_seconds.labels(queue_name)
+
+        async def _handle_message(channel, body, envelope, properties):
+            async with semaphore:
+                sent_at = message_sent_at(properties)
+                if sent_at is not None:
+                    latency_seconds.observe(max(time.time() - sent_at, 0))
+
+                try:
+                    message = codec.loads(body)
+                except (codec.DecodeError, TypeError) as err:
+                    failed.inc()
+                    _log.error('Wrong queue message [%r]: %r', body, err)
+                else:
+                    try:
+                        with handler_seconds.time():
+                            await callback(message)
+                    except RetryLater as err:
+                        try:
+                            await self._retry_message(channel, queue_name, queue_options,
+                                                      message, body, properties, err)
+                            retried.inc()
+                        except aioamqp.AioamqpException as publish_err:
+                            _log.error('Queue message #%s retry publish error: %r. Requeue it',
+                                       envelope.delivery_tag, publish_err)
+                            in_progress.dec()
+                            await self._requeue_message(channel, envelope.delivery_tag, ack_batcher)
+                            return
+                    except Exception as err:
+                        failed.inc()
+                        _log.exception('Queue message #%s handler error: %r', envelope.delivery_tag, err)
+
+            in_progress.dec()
+            try:
+                if ack_batcher is not None:
+                    await ack_batcher.complete(envelope.delivery_tag)
+                else:
+                    _log.debug('Send message #%s ack', envelope.delivery_tag)
+                    await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+            except aioamqp.AioamqpException as err:
+                _log.error('Queue message #%s ack error: %r', envelope.delivery_tag, err)
+                return
+            acked.inc()
+
         async def _on_message(channel, body, envelope, properties):
             _log.debug('Received message #%s: %r', envelope.delivery_tag, body)
+            received.inc()
+            in_progress.inc()
 
-            try:
-                message = json.loads(body.decode())
-            except (JSONDecodeError, TypeError) as err:
-                _log.error('Wrong queue message [%r]: %r', body, err)
-            else:
-                await callback(message)
+            if ack_batcher is not None:
+                ack_batcher.delivered(envelope.delivery_tag)
 
-            _log.debug('Send message #%s ack', envelope.delivery_tag)
-            await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+            task = asyncio.ensure_future(_handle_message(channel, body, envelope, properties))
+            self._handler_tasks.add(task)
+            task.add_done_callback(self._handler_tasks.discard)
 
         return _on_message
 
+    async def close(self):
+        """ Wait for running handlers and close connection to the RabbitMQ """
+        if self._handler_tasks:
+            _log.info('Wait for %d running queue handlers', len(self._handler_tasks))
+            await asyncio.wait(list(self._handler_tasks), timeout=self.CLOSE_TIMEOUT_SEC)
+
+        for ack_batcher in self._ack_batchers:
+            try:
+                await ack_batcher.close()
+            except aioamqp.AioamqpException as err:
+                _log.error('Queue acks flush error: %r', err)
+
+        await super().close()
+
     def start(self):
         _log.info('Start queue listener')
         asyncio.ensure_future(self.connect())
@@ -1,16 +1,15 @@
 import pytz
 import logging
-import asyncio
 from datetime import datetime
 
+import audit
 import utils
 from config import config
+from message_queue.connect import RetryLater
 
 __author__ = 'Kostel Serhii'
 
 
-_MAX_UPDATE_ATTEMPTS = 5
-
 _log = logging.getLogger('xop.mq.handler')
 
 
@@ -21,53 +20,49 @@ async def _report_error(pay_id, error):
     await utils.report_to_admin(subject="XOPAY: Transaction update error.", text=text)
 
 
-async def _update_transaction_retry(pay_id, url, method, body):
-    """ Retry transaction update """
-    errors = []
-
-    for attempt in range(_MAX_UPDATE_ATTEMPTS):
-
-        await asyncio.sleep(2 ** attempt)
-
-        attempt_msg = '(attempt: %d/%d)' % (attempt + 1, _MAX_UPDATE_ATTEMPTS)
-        _log.info('Update payment %s with: [%r] %s', pay_id, body, attempt_msg)
-
-        result, error = await utils.http_request(url=url, method=method, body=body)
-        if result:
-            _log.info('Payment %s updated successfully with: [%r]', pay_id, body)
-            return
+def _payment_url(pay_id):
+    return config.get('CLIENT_BASE_URL') + '/payment/%s' % pay_id
 
-        errors.append(error)
-        _log.error('Error update payment %s status! %s Retry after timeout...', pay_id, attempt_msg)
 
+async def transaction_retry_failed(message, error, attempts):
+    """
+    Transaction status queue retries exhausted callback.
+    :param message: json dict with information from queue
+    :param error: last update error
+    :param attempts: number of retry attempts
+    """
+    pay_id = message.get('id')
     _log.critical('ERROR! Payment %s NOT UPDATED!!!', pay_id)
-    err_msg = 'Payment NOT UPDATED after %d attempts. \n\nAll errors: \n%s\n'
-    asyncio.ensure_future(_report_error(pay_id, err_msg % (_MAX_UPDATE_ATTEMPTS, '\n'.join(errors))))
+    audit.record_delivery('payment', [_payment_url(pay_id)], 'failed', error=str(error),
+                          payment_id=pay_id, attempts=attempts + 1)
+    err_msg = 'Payment NOT UPDATED after %d attempts. \n\nLast error: \n%s\n' % (attempts + 1, error)
+    await _report_error(pay_id, err_msg)
 
 
 async def transaction_queue_handler(message):
     """
     Transaction status queue handler.
-    Retry update on error.
+    Retry update on error with the broker delay queues.
     :param message: json dict with information from queue
+    :raise RetryLater: payment status not updated
     """
     pay_id, pay_status, redirect_url = message.get('id'), message.get('status'), message.get('redirect_url')
     if not pay_id or not pay_status:
         _log.error('Missing required fields in transaction queue message [%r]. Skip notify!', message)
         return
 
-    url = config.get('CLIENT_BASE_URL') + '/payment/%s' % pay_id
+    url = _payment_url(pay_id)
     request_kwargs = dict(url=url, method='PUT', body={'status': pay_status, 'redirect_url': redirect_url})
 
     result, error = await utils.http_request(**request_kwargs)
 
     if error:
-        _log.error('Error update payment %s status! Try again later in the background...', pay_id)
-        asyncio.ensure_future(_report_error(pay_id, error))
-        asyncio.ensure_future(_update_transaction_retry(pay_id, **request_kwargs))
-        return
+        _log.error('Error update payment %s status! Try again later...', pay_id)
+        audit.record_delivery('payment', [url], 'retry', error=error, payment_id=pay_id, payment_status=pay_status)
+        raise RetryLater(error)
 
     _log.info('Payment %s updated successfully with status: %s', pay_id, pay_status)
+    audit.record_delivery('payment', [url], 'sent', payment_id=pay_id, payment_status=pay_status)
 
 
 async def email_queue_handler(message):
@@ -79,7 +74,9 @@ async def email_queue_handler(message):
         _log.error('Wrong fields in email queue request: [%r]. Skip notify!', message)
         return
 
-    await utils.send_email(**message)
+    rejected = await utils.send_email(**message)
+    audit.record_delivery('email', [message['email_to']], audit.delivery_status([message['email_to']], rejected),
+                          subject=message['subject'], rejected=sorted(rejected))
 
 
 async def sms_queue_handler(message):
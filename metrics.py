@@ -0,0 +1,281 @@
+import time
+import logging
+from bisect import bisect_left
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.metrics')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Timer:
+    """ Context manager to observe block duration in the histogram. """
+
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _CounterValue:
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeValue:
+
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """ Get gauge value from the function on collect. """
+        self.function = function
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception as err:
+            _log.error('Gauge function error: %r', err)
+            return float('nan')
+
+
+class _HistogramValue:
+
+    __slots__ = ('upper_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * len(upper_bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.upper_bounds, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Metric:
+    """
+    Metric with optional labels.
+    Values for the label values are created on the first use
+    and cached, so callers can keep them to skip labels lookup.
+    """
+
+    type_name = None
+    value_class = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = dict()
+        self._series = dict()
+
+    def _new_value(self):
+        return self.value_class()
+
+    def labels(self, *label_values):
+        """
+        Get metric value for the label values.
+        :param label_values: values in the order of label names
+        :return: metric value
+        """
+        value = self._values.get(label_values)
+        if value is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError('Metric %s expects labels %r, got %r' % (self.name, self.label_names, label_values))
+            series_key = tuple(str(label_value) for label_value in label_values)
+            value = self._series.get(series_key)
+            if value is None:
+                value = self._new_value()
+                self._series[series_key] = value
+            self._values[label_values] = value
+        return value
+
+    def _samples(self):
+        """ Sample lines (without HELP and TYPE). """
+        raise NotImplementedError()
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation.replace('\n', ' ')),
+                 '# TYPE %s %s' % (self.name, self.type_name)]
+        lines.extend(self._samples())
+        return lines
+
+    def _sorted_series(self):
+        """ Label values (as strings) and metric values. """
+        return sorted(self._series.items(), key=lambda item: item[0])
+
+
+class Counter(_Metric):
+
+    type_name = 'counter'
+    value_class = _CounterValue
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.label_names, labels), _format_value(value.value))
+                for labels, value in self._sorted_series()]
+
+
+class Gauge(_Metric):
+
+    type_name = 'gauge'
+    value_class = _GaugeValue
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set_function(self, function):
+        self.labels().set_function(function)
+
+    def _samples(self):
+        return ['%s%s %s' % (self.name, _format_labels(self.label_names, labels), _format_value(value.get()))
+                for labels, value in self._sorted_series()]
+
+
+class Histogram(_Metric):
+    """ Histogram with fixed buckets upper bounds. """
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.upper_bounds = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _samples(self):
+        lines = []
+        for labels, value in self._sorted_series():
+            cumulative = 0
+            for upper_bound, count in zip(self.upper_bounds, value.counts):
+                cumulative += count
+                bucket_label = 'le="%s"' % _format_value(float(upper_bound))
+                lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.label_names, labels, bucket_label),
+                                                 cumulative))
+            lines.append('%s_bucket%s %d' % (self.name, _format_labels(self.label_names, labels, 'le="+Inf"'),
+                                             value.count))
+            label_str = _format_labels(self.label_names, labels)
+            lines.append('%s_sum%s %s' % (self.name, label_str, _format_value(value.sum)))
+            lines.append('%s_count%s %d' % (self.name, label_str, value.count))
+        return lines
+
+
+class Registry:
+    """ Metrics collection with Prometheus text exposition. """
+
+    def __init__(self):
+        self._metrics = dict()
+
+    def register(self, metric):
+        """
+        Add metric to the registry.
+        :param metric: metric instance
+        :return: registered metric (existing one, if metric with the same name and type is registered)
+        :raise ValueError: metric name is used by the metric of another type
+        """
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                raise ValueError('Metric %s is already registered' % metric.name)
+            return existing
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def expose(self):
+        """ All metrics in Prometheus text format. """
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, label_names=(), registry=REGISTRY):
+    return registry.register(Counter(name, documentation, label_names))
+
+
+def gauge(name, documentation, label_names=(), registry=REGISTRY):
+    return registry.register(Gauge(name, documentation, label_names))
+
+
+def histogram(name, documentation, label_names=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+    return registry.register(Histogram(name, documentation, label_names, buckets))
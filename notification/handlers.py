@@ -1,10 +1,15 @@
-import json
+import threading
 from uuid import uuid4
 from aiohttp import web
+from bson import ObjectId
+from bson.errors import InvalidId
 from marshmallow import Schema, fields, validates_schema
 from marshmallow.validate import Length
 
+import audit
 import auth
+import codec
+import metrics
 from errors import ValidationError, NotFoundError
 
 __author__ = 'Kostel Serhii'
@@ -26,24 +31,233 @@ class NotificationSchema(Schema):
             raise ValidationError('Wrong request body or Content-Type header missing')
 
 
+class _Schemas(threading.local):
+    """
+    Notification schemas, created once per thread.
+    Marshmallow schema instance keeps state between calls and is not thread-safe.
+    """
+
+    def __init__(self):
+        self.full = NotificationSchema()
+        self.partial = NotificationSchema(partial=True)
+        self.many = NotificationSchema(many=True)
+
+
+_schemas = _Schemas()
+
+
+NOTIFICATIONS_MAX_LIMIT = 1000
+DELIVERIES_MAX_LIMIT = 1000
+DELIVERIES_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# response field name: document field name
+notification_dump_fields = {
+    'id': '_id',
+    'name': 'name',
+    'case_regex': 'case_regex',
+    'case_template': 'case_template',
+    'header_template': 'header_template',
+    'body_template': 'body_template',
+    'subscribers_template': 'subscribers_template',
+}
+
+_all_dump_fields = tuple(notification_dump_fields.items())
+_missing = object()
+
+
+def dump_notification(notification, dump_fields=_all_dump_fields):
+    """
+    Fast notification dump for read-only responses.
+    Same result as NotificationSchema dump for the fixed string fields
+    without marshmallow generic serialization.
+    :param dict notification: notification document from database
+    :param dump_fields: tuple of (response field name, document field name) pairs
+    :return: dict with serialized notification
+    """
+    result = {}
+    for name, doc_field in dump_fields:
+        value = notification.get(doc_field, _missing)
+        if value is _missing:
+            continue
+        result[name] = value if value is None or type(value) is str else str(value)
+    return result
+
+
 def jsonify(*args, **kwargs):
-    return web.Response(text=json.dumps(dict(*args, **kwargs)), content_type='application/json')
+    return web.Response(body=codec.dumps_bytes(dict(*args, **kwargs)), content_type='application/json')
+
+
+def _notifications_list_params(request):
+    """
+    Parse and validate notifications list query arguments:
+        limit - maximum number of notifications in response
+        after - cursor: return notifications with id greater than this id
+        fields - comma separated response fields (e.g. id,name)
+        format - response format: json (default) or ndjson
+        stream - 1/true: stream response from database cursor with chunked encoding
+    :param request: Request instance with request information
+    :return: dict with parsed arguments
+    :raise ValidationError: wrong query arguments
+    """
+    query = request.GET
+    errors = {}
+
+    limit = query.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+            if not 0 < limit <= NOTIFICATIONS_MAX_LIMIT:
+                raise ValueError()
+        except ValueError:
+            errors['limit'] = ['Must be an integer from 1 to %d' % NOTIFICATIONS_MAX_LIMIT]
+
+    fields_arg = query.get('fields')
+    dump_fields = _all_dump_fields
+    if fields_arg:
+        requested = [name.strip() for name in fields_arg.split(',') if name.strip()]
+        wrong_fields = [name for name in requested if name not in notification_dump_fields]
+        if wrong_fields:
+            errors['fields'] = ['Unknown fields: %s' % ', '.join(wrong_fields)]
+        else:
+            dump_fields = tuple((name, notification_dump_fields[name]) for name in requested)
+
+    output_format = query.get('format', 'json')
+    if output_format not in ('json', 'ndjson'):
+        errors['format'] = ['Must be one of: json, ndjson']
+
+    if errors:
+        raise ValidationError(errors=errors)
+
+    return dict(
+        limit=limit,
+        after=query.get('after'),
+        dump_fields=dump_fields,
+        output_format=output_format,
+        stream=query.get('stream', '').lower() in ('1', 'true') or output_format == 'ndjson',
+    )
+
+
+def _notifications_cursor(db, limit=None, after=None, dump_fields=_all_dump_fields):
+    """
+    Database cursor with notifications ordered by id.
+    :param db: database
+    :param limit: maximum number of notifications
+    :param after: return notifications with id greater than this id
+    :param dump_fields: tuple of (response field name, document field name) pairs to load
+    :return: motor cursor
+    """
+    spec = {'_id': {'$gt': after}} if after else {}
+    projection = {doc_field: True for _, doc_field in dump_fields}
+
+    cursor = db.notifications.find(spec, projection).sort('_id', 1)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+async def _stream_notifications(request, cursor, dump_fields, output_format, limit=None):
+    """
+    Stream notifications from database cursor as chunked JSON or NDJSON
+    without loading all of them to the memory.
+    """
+    response = web.StreamResponse()
+    response.content_type = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    separator, last_id, count = b'', None, 0
+    if output_format != 'ndjson':
+        response.write(b'{"notifications": [')
+
+    while (await cursor.fetch_next):
+        notification = cursor.next_object()
+        last_id, count = notification['_id'], count + 1
+        data = codec.dumps_bytes(dump_notification(notification, dump_fields))
+
+        if output_format == 'ndjson':
+            response.write(data + b'\n')
+        else:
+            response.write(separator + data)
+            separator = b', '
+        await response.drain()
+
+    if output_format != 'ndjson':
+        next_id = last_id if limit and count == limit else None
+        response.write(b'], "next": ' + codec.dumps_bytes(next_id) + b'}')
+
+    await response.write_eof()
+    return response
+
+
+def _deliveries_list_params(request):
+    """
+    Parse and validate delivery records query arguments:
+        rule_id, recipient, channel, status - filters
+        before - cursor: return records older than the record with this id (see "before" in response)
+        limit - maximum number of records in response (default 100)
+    :param request: Request instance with request information
+    :return: dict with parsed arguments
+    :raise ValidationError: wrong query arguments
+    """
+    query = request.GET
+    errors = {}
+
+    limit = query.get('limit', 100)
+    try:
+        limit = int(limit)
+        if not 0 < limit <= DELIVERIES_MAX_LIMIT:
+            raise ValueError()
+    except ValueError:
+        errors['limit'] = ['Must be an integer from 1 to %d' % DELIVERIES_MAX_LIMIT]
+
+    before = query.get('before')
+    if before:
+        try:
+            before = ObjectId(before)
+        except (InvalidId, TypeError):
+            errors['before'] = ['Must be a delivery record id']
+
+    if errors:
+        raise ValidationError(errors=errors)
+
+    params = {name: query.get(name) for name in ('rule_id', 'recipient', 'channel', 'status')}
+    params.update(before=before, limit=limit)
+    return params
+
+
+def dump_delivery(record):
+    """
+    Dump delivery record from database.
+    :param dict record: delivery record
+    :return: dict with serialized record
+    """
+    result = {name: value for name, value in record.items() if name not in ('_id', 'created_at')}
+    result['id'] = str(record['_id'])
+    result['created_at'] = record['created_at'].strftime(DELIVERIES_DATETIME_FORMAT)
+    return result
 
 
 # Handlers
 
 @auth.auth('admin')
 async def notifications_list(request):
-    notifications = await request.app['db'].notifications.find().to_list(None)
+    params = _notifications_list_params(request)
+    dump_fields = params['dump_fields']
+    cursor = _notifications_cursor(request.app['db'], params['limit'], params['after'], dump_fields)
+
+    if params['stream']:
+        return await _stream_notifications(request, cursor, dump_fields, params['output_format'], params['limit'])
 
-    schema = NotificationSchema(many=True)
-    result = schema.dump(notifications)
-    return jsonify(notifications=result.data)
+    notifications = await cursor.to_list(None)
+    next_id = notifications[-1]['_id'] if params['limit'] and len(notifications) == params['limit'] else None
+
+    result = [dump_notification(notification, dump_fields) for notification in notifications]
+    return jsonify(notifications=result, next=next_id)
 
 
 @auth.auth('admin')
 async def notification_create(request):
-    schema = NotificationSchema()
+    schema = _schemas.full
     body_json = await request.json()
     data, errors = schema.load(body_json)
     if errors:
@@ -51,7 +265,7 @@ async def notification_create(request):
 
     data['_id'] = str(uuid4())
     await request.app['db'].notifications.insert(data)
-    await request.app['notify_processor'].load_notify_nodes()
+    request.app['notify_processor'].update_notify_node(data)
 
     result = schema.dump(data)
     return jsonify(result.data)
@@ -64,10 +278,7 @@ async def notification_detail(request):
     if not notification:
         raise NotFoundError()
 
-    schema = NotificationSchema()
-    result = schema.dump(notification)
-
-    return jsonify(result.data)
+    return jsonify(dump_notification(notification))
 
 
 @auth.auth('admin')
@@ -80,16 +291,18 @@ async def notification_update(request):
     body_json = await request.json()
     changed_fields = dict(set(body_json.items()) - set(notification.items()))
 
-    schema = NotificationSchema(partial=True)
+    schema = _schemas.partial
     data, errors = schema.load(changed_fields)
     if errors:
         raise ValidationError(errors=errors)
 
     if data:
         await request.app['db'].notifications.update({'_id': notify_id}, {'$set': data})
-        await request.app['notify_processor'].load_notify_nodes()
 
     notification = await request.app['db'].notifications.find_one({'_id': notify_id})
+    if data and notification:
+        request.app['notify_processor'].update_notify_node(notification)
+
     result = schema.dump(notification)
     return jsonify(result.data)
 
@@ -101,5 +314,26 @@ async def notification_delete(request):
     if result['n'] == 0:
         raise NotFoundError()
 
-    await request.app['notify_processor'].load_notify_nodes()
+    request.app['notify_processor'].remove_notify_node(notify_id)
     return web.Response(status=200, content_type='application/json')
+
+
+@auth.auth('admin')
+async def deliveries_list(request):
+    audit_log = audit.get_audit_log()
+    if audit_log is None:
+        raise NotFoundError('Delivery log is not enabled')
+
+    params = _deliveries_list_params(request)
+    records = await audit_log.find(**params)
+
+    before = None
+    if records and len(records) == params['limit']:
+        before = str(records[-1]['_id'])
+
+    return jsonify(deliveries=[dump_delivery(record) for record in records], before=before)
+
+
+async def metrics_export(request):
+    """ Service metrics in Prometheus text format. """
+    return web.Response(body=metrics.REGISTRY.expose().encode(), headers={'Content-Type': metrics.CONTENT_TYPE})
@@ -2,15 +2,25 @@ import re
 import asyncio
 import logging
 import jinja2
+import jinja2.meta
 from itertools import chain
-from collections import namedtuple
+from types import MappingProxyType
+from collections import namedtuple, OrderedDict
 
+import audit
 import utils
+import metrics
 
 __author__ = 'Kostel Serhii'
 
 _log = logging.getLogger('xop.notify')
 
+_stage_seconds = metrics.histogram('notify_request_stage_seconds', 'Request queue processing stage latency', ('stage',))
+_rule_set_size = metrics.gauge('notify_rule_set_size', 'Notify nodes in the current rule set')
+_rule_set_version = metrics.gauge('notify_rule_set_version', 'Current rule set version')
+_load_seconds = metrics.histogram('notify_rules_load_seconds', 'Notify nodes load from database and compile time',
+                                  buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
 
 BaseNotifyNode = namedtuple(
     'BaseNotifyNode',
@@ -20,6 +30,14 @@ NotifyNode = namedtuple(
     'NotifyNode',
     'id, name, case_regex, case, header, body, subscribers'
 )
+CompiledNotifyNode = namedtuple(
+    'CompiledNotifyNode',
+    'base, templates, case_variables, matches_empty'
+)
+NotifyRuleSet = namedtuple(
+    'NotifyRuleSet',
+    'version, nodes, node_index, unindexed_ids'
+)
 
 email_name2url = dict(
     group='/emails/groups/%s',
@@ -32,69 +50,350 @@ recursive_urls_regex = re.compile(r'(?:%s)' % '|'.join((url % '[\w-]+' for url i
 email_regex = re.compile(r'(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)')
 email_pattern_regex = re.compile(r'^(?:%s):[\w-]+$' % '|'.join(email_name2url.keys()))
 
+template_names = ('case_template', 'header_template', 'body_template', 'subscribers_template')
+
+
+class TemplateCache:
+    """
+    Bounded LRU cache with compiled notification templates.
+    Templates are compiled once into the shared jinja environment
+    and stored by key (notify node id, template source hash).
+    """
+
+    def __init__(self, max_size=1024):
+        """
+        :param int max_size: maximum number of compiled templates
+        """
+        self.max_size = max_size
+        self._environment = jinja2.Environment()
+        self._templates = OrderedDict()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def get(self, node_id, source):
+        """
+        Return compiled template for the notify node.
+        Compile and store template on cache miss.
+        :param node_id: notify node id
+        :param str source: template source
+        :return: jinja2 template
+        :raise jinja2.TemplateSyntaxError: wrong template source
+        """
+        key = (node_id, hash(source))
+
+        template = self._templates.get(key)
+        if template is not None:
+            self._templates.move_to_end(key)
+            return template
+
+        template = self._environment.from_string(source)
+        self._templates[key] = template
+        if len(self._templates) > self.max_size:
+            self._templates.popitem(last=False)
+
+        return template
+
+    def evict(self, node_id):
+        """
+        Remove all compiled templates of the notify node.
+        :param node_id: notify node id
+        """
+        for key in [key for key in self._templates if key[0] == node_id]:
+            del self._templates[key]
+
+    def undeclared_variables(self, source):
+        """
+        Find top-level variables, that template takes from the render context.
+        :param str source: template source
+        :return: frozenset with variable names
+        :raise jinja2.TemplateSyntaxError: wrong template source
+        """
+        return frozenset(jinja2.meta.find_undeclared_variables(self._environment.parse(source)))
+
 
 class NotifyProcessing:
 
-    _base_node_storage = set()
     _compiled_regex = dict()
 
-    def __init__(self, db, admin_base_url):
+    def __init__(self, db, admin_base_url, template_cache_size=1024):
         self.db = db
         self.admin_base_url = admin_base_url
+        self._template_cache = TemplateCache(max_size=template_cache_size)
+        self._reload_task = None
+        self._rule_set = NotifyRuleSet(version=0, nodes=MappingProxyType({}),
+                                       node_index=MappingProxyType({}), unindexed_ids=frozenset())
+
+    @property
+    def rule_set(self):
+        """Current immutable notify rule set snapshot."""
+        return self._rule_set
 
     async def _remove_bad_node(self, node):
         """Remove bad node from internal storage and database."""
         _log.warning('Remove bad notify node "%s" from storage', node.name)
 
-        if node in self._base_node_storage:
-            self._base_node_storage.remove(node)
+        self.remove_notify_node(node.id)
 
         await self.db.notifications.remove(node.id)
 
-    def start(self):
+    def _compile_node(self, notify):
+        """
+        Create base node from notification document and
+        compile its templates with the template cache.
+        :param dict notify: notification document from database
+        :return: compiled notify node
+        :raise jinja2.TemplateSyntaxError: wrong template source
+        """
+        base_node = BaseNotifyNode(
+            id=notify['_id'],
+            name=notify['name'],
+            case_regex=notify['case_regex'],
+            case_template=notify['case_template'],
+            header_template=notify['header_template'],
+            body_template=notify['body_template'],
+            subscribers_template=notify['subscribers_template']
+        )
+        templates = {name: self._template_cache.get(base_node.id, getattr(base_node, name))
+                     for name in template_names}
+        return CompiledNotifyNode(
+            base=base_node,
+            templates=templates,
+            case_variables=self._template_cache.undeclared_variables(base_node.case_template),
+            matches_empty=self._case_matches_empty(templates['case_template'], base_node.case_regex)
+        )
+
+    @staticmethod
+    def _case_matches_empty(case_template, case_regex):
+        """
+        Check whether case template, rendered without message values, matches case regex.
+        Missing variables may render as empty string or default value
+        (e.g. "{{ name }}", "{{ status|default('none') }}") and templates
+        may use only globals (e.g. range), so such node matches messages
+        without any of its case variables.
+        :param case_template: compiled case template
+        :param str case_regex: case regex source
+        :return: True if node matches message without case variables
+        """
+        try:
+            return bool(re.match(case_regex, case_template.render({})))
+        except Exception:
+            return False
+
+    def _publish_rule_set(self, nodes, node_index, unindexed_ids):
+        """
+        Swap current rule set with the new snapshot.
+        Messages in processing keep working with the previous snapshot.
+        """
+        self._rule_set = NotifyRuleSet(
+            version=self._rule_set.version + 1,
+            nodes=MappingProxyType(nodes),
+            node_index=MappingProxyType(node_index),
+            unindexed_ids=frozenset(unindexed_ids)
+        )
+        _rule_set_size.set(len(nodes))
+        _rule_set_version.set(self._rule_set.version)
+        _log.debug('Publish notify rule set version %d (%d nodes)', self._rule_set.version, len(nodes))
+
+    @staticmethod
+    def _index_node(node_index, unindexed_ids, compiled_node, add=True):
+        """
+        Add (or remove) compiled node to the index from top-level message keys
+        to the node ids, which case template depends on this keys.
+        Only case template is indexed, because it is the only one
+        that decides whether node matches the message.
+        Nodes with constant case template or case, that matches
+        without message values (see _case_matches_empty), can not be indexed.
+        Changed index values are replaced with the new frozensets.
+        :param dict node_index: index to change
+        :param set unindexed_ids: ids of nodes, that can not be indexed
+        :param compiled_node: compiled notify node
+        :param add: True - add node to index, False - remove node from index
+        """
+        node_id = compiled_node.base.id
+        variables = compiled_node.case_variables
+
+        if not variables or compiled_node.matches_empty:
+            if add:
+                unindexed_ids.add(node_id)
+            else:
+                unindexed_ids.discard(node_id)
+            return
+
+        for variable in variables:
+            ids = node_index.get(variable, frozenset())
+            ids = ids | {node_id} if add else ids - {node_id}
+            if ids:
+                node_index[variable] = ids
+            else:
+                node_index.pop(variable, None)
+
+    def start(self, reload_interval=None):
+        """
+        Load notify nodes.
+        :param reload_interval: time in seconds to reload notify nodes from database.
+            Used by processes, that do not get notifications changes from API. If None - load once
+        """
         _log.info('Start notify processing')
-        asyncio.ensure_future(self.load_notify_nodes())
+        if reload_interval:
+            self._reload_task = asyncio.ensure_future(self._reload_loop(reload_interval))
+        else:
+            asyncio.ensure_future(self.load_notify_nodes())
+
+    def stop(self):
+        if self._reload_task is not None:
+            self._reload_task.cancel()
+            self._reload_task = None
+
+    async def _reload_loop(self, reload_interval):
+        while True:
+            try:
+                await self.load_notify_nodes()
+            except asyncio.CancelledError:
+                break
+            except Exception as err:
+                _log.exception('Reload notify nodes error: %r', err)
+
+            try:
+                await asyncio.sleep(reload_interval)
+            except asyncio.CancelledError:
+                break
 
     async def load_notify_nodes(self):
         """
-        Load base notify nodes from database
-        and add to internal storage.
+        Load all notifications from database,
+        compile it and publish as new rule set.
         """
-        self._base_node_storage = set()
-        notifications = await self.db.notifications.find().to_list(None)
+        with _load_seconds.time():
+            notifications = await self.db.notifications.find().to_list(None)
+            self.build_rule_set(notifications)
+
+    def build_rule_set(self, notifications):
+        """
+        Compile notifications and publish them as new rule set.
+        Notifications with wrong templates are removed.
+        :param notifications: iterable with notification documents
+        """
+        nodes = dict()
+        node_index = dict()
+        unindexed_ids = set()
 
         for notify in notifications:
-            base_node = BaseNotifyNode(
-                id=notify['_id'],
-                name=notify['name'],
-                case_regex=notify['case_regex'],
-                case_template=notify['case_template'],
-                header_template=notify['header_template'],
-                body_template=notify['body_template'],
-                subscribers_template=notify['subscribers_template']
-            )
-            self._base_node_storage.add(base_node)
-
-    def rendered_notify_nodes(self, values):
-        """
-        Generator, that yield rendered base node templates
-        with values from values dict.
+            try:
+                compiled_node = self._compile_node(notify)
+            except jinja2.TemplateSyntaxError as err:
+                _log.warning('Notify node "%s" template syntax error: %s', notify.get('name'), err)
+                self._template_cache.evict(notify['_id'])
+                asyncio.ensure_future(self.db.notifications.remove(notify['_id']))
+                continue
+
+            nodes[compiled_node.base.id] = compiled_node
+            self._index_node(node_index, unindexed_ids, compiled_node)
+
+        self._publish_rule_set(nodes, node_index, unindexed_ids)
+
+    def update_notify_node(self, notify):
+        """
+        Add new or replace existing notify node.
+        Only this node templates are compiled.
+        :param dict notify: notification document from database
+        :return: True if node added, False if node has wrong template
+        """
+        notify_id = notify['_id']
+        self._template_cache.evict(notify_id)
+
+        try:
+            compiled_node = self._compile_node(notify)
+        except jinja2.TemplateSyntaxError as err:
+            _log.warning('Notify node "%s" template syntax error: %s', notify.get('name'), err)
+            self.remove_notify_node(notify_id)
+            asyncio.ensure_future(self.db.notifications.remove(notify_id))
+            return False
+
+        rule_set = self._rule_set
+        nodes = dict(rule_set.nodes)
+        node_index = dict(rule_set.node_index)
+        unindexed_ids = set(rule_set.unindexed_ids)
+
+        old_node = nodes.get(notify_id)
+        if old_node is not None:
+            self._index_node(node_index, unindexed_ids, old_node, add=False)
+
+        nodes[notify_id] = compiled_node
+        self._index_node(node_index, unindexed_ids, compiled_node)
+
+        self._publish_rule_set(nodes, node_index, unindexed_ids)
+        return True
+
+    def remove_notify_node(self, notify_id):
+        """
+        Remove notify node from rule set and drop its compiled templates.
+        :param notify_id: notify node id
+        """
+        self._template_cache.evict(notify_id)
+
+        rule_set = self._rule_set
+        old_node = rule_set.nodes.get(notify_id)
+        if old_node is None:
+            return
+
+        nodes = dict(rule_set.nodes)
+        node_index = dict(rule_set.node_index)
+        unindexed_ids = set(rule_set.unindexed_ids)
+
+        del nodes[notify_id]
+        self._index_node(node_index, unindexed_ids, old_node, add=False)
+
+        self._publish_rule_set(nodes, node_index, unindexed_ids)
+
+    def candidate_notify_nodes(self, values, rule_set=None):
+        """
+        Compiled nodes, that can match the message.
+        Node is a candidate if message has at least one variable,
+        used in the node case template, or node is not indexed
+        (case template has no variables or matches without them).
+        Case template without any of its variables in the message renders
+        the same as with empty values: raises undefined error or gives
+        the constant string, that was checked with case regex at compile time.
+        :param dict values: message values to fill templates
+        :param rule_set: rule set snapshot. If None - use current rule set
+        :return: list with compiled nodes
+        """
+        rule_set = rule_set or self._rule_set
+
+        candidate_ids = set(rule_set.unindexed_ids)
+        if isinstance(values, dict):
+            node_index = rule_set.node_index
+            for key in values:
+                ids = node_index.get(key)
+                if ids:
+                    candidate_ids.update(ids)
+
+        return [rule_set.nodes[node_id] for node_id in candidate_ids]
+
+    def rendered_notify_nodes(self, values, nodes=None):
+        """
+        Generator, that yield notify nodes with rendered case template
+        with values from values dict (first stage of the processing).
+        Header, body and subscribers are rendered later,
+        only for matched nodes (see completed_notify_nodes).
         :param dict values: values to fill templates
+        :param nodes: compiled nodes to render. If None - render all nodes
         """
-        def fill_template(template):
-            return jinja2.Template(template).render(values)
+        compiled_nodes = self._rule_set.nodes.values() if nodes is None else nodes
 
-        for base_node in self._base_node_storage.copy():
+        for compiled_node in compiled_nodes:
+            base_node = compiled_node.base
             try:
 
                 notify_node = NotifyNode(
-                    id=base_node._id,
+                    id=base_node.id,
                     name=base_node.name,
                     case_regex=base_node.case_regex,
-                    case=fill_template(base_node.case_template),
-                    header=fill_template(base_node.header_template),
-                    body=fill_template(base_node.body_template),
-                    subscribers=fill_template(base_node.subscribers_template)
+                    case=compiled_node.templates['case_template'].render(values),
+                    header=None,
+                    body=None,
+                    subscribers=None
                 )
                 yield notify_node
 
@@ -105,6 +404,7 @@ class NotifyProcessing:
     def matched_notify_nodes(self, nodes):
         """
         Generator, that yields matched notification nodes
+        (second stage of the processing).
         :param nodes: notify nodes to check matched cases
         """
         for node in nodes:
@@ -128,6 +428,34 @@ class NotifyProcessing:
             except ValueError as err:
                 _log.warning('Match node "%s" value error: %s', node.name, err)
 
+    def completed_notify_nodes(self, nodes, values, rule_set=None):
+        """
+        Generator, that yields notify nodes with rendered
+        header, body and subscribers templates (last stage of the processing).
+        :param nodes: matched notify nodes
+        :param dict values: values to fill templates
+        :param rule_set: rule set snapshot, used at the first stage. If None - use current rule set
+        """
+        compiled_nodes = (rule_set or self._rule_set).nodes
+
+        for node in nodes:
+            compiled_node = compiled_nodes.get(node.id)
+            if compiled_node is None:
+                continue
+
+            templates = compiled_node.templates
+            try:
+
+                yield node._replace(
+                    header=templates['header_template'].render(values),
+                    body=templates['body_template'].render(values),
+                    subscribers=templates['subscribers_template'].render(values)
+                )
+
+            except jinja2.TemplateError as err:
+                _log.warning('Notify node "%s" template render error: %s', node.name, err)
+                asyncio.ensure_future(self._remove_bad_node(node))
+
     async def extract_subscriber_emails(self, subscribers_str):
         """
         Parse subscribers string to get emails for notification.
@@ -140,7 +468,6 @@ class NotifyProcessing:
         :param subscribers_str: string with subscribers info
         :return: emails set
         """
-        # TODO: add caching
         subscribers = set(map(str.strip, subscribers_str.split(',')))
 
         emails = set(filter(email_regex.match, subscribers))
@@ -150,14 +477,13 @@ class NotifyProcessing:
         request_email_urls = [self.admin_base_url + email_name2url[name] % data for name, data in request_emails_raw_info]
 
         if request_email_urls:
-            request_email_futures, _ = await asyncio.wait(list(map(utils.http_request, request_email_urls)))
-            request_email_json_iter = filter(None, (ref.result()[0] for ref in request_email_futures))
+            request_email_results = await asyncio.gather(*map(utils.get_emails, request_email_urls))
+            request_email_json_iter = filter(None, (result for result, _ in request_email_results))
             request_emails = set(chain.from_iterable(resp.get('emails', []) for resp in request_email_json_iter))
 
-            request_errors = list(filter(None, (ref.result()[1] for ref in request_email_futures)))
+            request_errors = [(url, err) for url, (_, err) in zip(request_email_urls, request_email_results) if err]
             if request_errors:
-                _log.warning('Request email errors: %s',
-                             ' '.join(map(str, ((url, err) for url, err in zip(request_email_urls, request_errors)))))
+                _log.warning('Request email errors: %s', ' '.join(map(str, request_errors)))
 
         emails = emails | request_emails
 
@@ -171,7 +497,11 @@ class NotifyProcessing:
         emails = await self.extract_subscriber_emails(node.subscribers)
         if emails:
             _log.info('Send notification "%s" to emails: %s' % (node.name, str(emails)))
-            await asyncio.wait([utils.send_email(email, node.header, node.body) for email in emails])
+            rejected = await utils.send_bulk_email(emails, node.header, node.body)
+            if rejected:
+                _log.warning('Notification "%s" rejected for emails: %s' % (node.name, str(rejected)))
+            audit.record_delivery('email', emails, audit.delivery_status(emails, rejected),
+                                  rule_id=node.id, subject=node.header, rejected=sorted(rejected))
         else:
             _log.warning('Emails for notification "%s" not found: [%s]' % (node.name, node.subscribers))
 
@@ -181,10 +511,18 @@ class NotifyProcessing:
         :param message: json dict with information from queue
         """
         try:
-            rendered_nodes = self.rendered_notify_nodes(message)
-            matched_nodes = list(self.matched_notify_nodes(rendered_nodes))
-            if matched_nodes:
-                await asyncio.wait(list(map(self.send_notification, matched_nodes)))
+            rule_set = self._rule_set
+            with _stage_seconds.labels('candidates').time():
+                candidate_nodes = self.candidate_notify_nodes(message, rule_set)
+            with _stage_seconds.labels('render').time():
+                rendered_nodes = list(self.rendered_notify_nodes(message, candidate_nodes))
+            with _stage_seconds.labels('match').time():
+                matched_nodes = list(self.matched_notify_nodes(rendered_nodes))
+            with _stage_seconds.labels('complete').time():
+                completed_nodes = list(self.completed_notify_nodes(matched_nodes, message, rule_set))
+            if completed_nodes:
+                with _stage_seconds.labels('send').time():
+                    await asyncio.wait(list(map(self.send_notification, completed_nodes)))
         except Exception as err:
             _log.exception('Error match notification nodes for message [%s]: %s', message, err)
 
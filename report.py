@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from datetime import datetime
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.report')
+
+
+class _Digest:
+    """ Reports with the same subject collected during the window. """
+
+    def __init__(self):
+        self.count = 0
+        self.samples = []
+        self.first_time = datetime.utcnow()
+        self.last_time = self.first_time
+
+
+class ReportAggregator:
+    """
+    Collect reports by subject during the time window
+    and send one digest per subject with reports count and samples.
+    Number of queued reports is limited, reports over the limit are only counted.
+    """
+
+    def __init__(self, send_report, window=60, max_entries=1000, max_samples=10):
+        """
+        :param send_report: coroutine function (subject, text) to send report
+        :param window: time window in seconds to collect reports
+        :param int max_entries: maximum number of queued reports
+        :param int max_samples: maximum number of report samples in one digest
+        """
+        self._send_report = send_report
+        self.window = window
+        self.max_entries = max_entries
+        self.max_samples = max_samples
+
+        self._digests = dict()
+        self._entries = 0
+        self._flush_handle = None
+
+    def add(self, subject, text):
+        """
+        Add report to the current window digest.
+        :param str subject: report subject
+        :param str text: report text
+        """
+        digest = self._digests.get(subject)
+        if digest is None:
+            digest = _Digest()
+            self._digests[subject] = digest
+
+        digest.count += 1
+        digest.last_time = datetime.utcnow()
+
+        if self._entries < self.max_entries and len(digest.samples) < self.max_samples:
+            digest.samples.append(text)
+            self._entries += 1
+
+        if self._flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(self.window, lambda: asyncio.ensure_future(self.flush()))
+
+    @staticmethod
+    def _digest_text(digest):
+        """ Format digest text with reports count and samples. """
+        if digest.count == 1 and digest.samples:
+            return digest.samples[0]
+
+        header = '{count} reports from {first} to {last} (UTC). Showing {shown} samples.'.format(
+            count=digest.count, first=digest.first_time, last=digest.last_time, shown=len(digest.samples))
+        samples = ('--- Sample {n} ---\n{text}'.format(n=n, text=text) for n, text in enumerate(digest.samples, 1))
+        return '\n\n'.join([header] + list(samples))
+
+    async def flush(self):
+        """ Send all collected digests. """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        digests, self._digests = self._digests, dict()
+        self._entries = 0
+
+        for subject, digest in digests.items():
+            if digest.count > 1:
+                subject = '%s (x%d)' % (subject, digest.count)
+            try:
+                await self._send_report(subject, self._digest_text(digest))
+            except Exception as err:
+                _log.exception('Send report "%s" error: %r', subject, err)
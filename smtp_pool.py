@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import aiosmtplib
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.smtp')
+
+
+class SMTPPoolError(Exception):
+    pass
+
+
+class _PooledConnection:
+    """ Authenticated SMTP connection with usage statistics. """
+
+    def __init__(self, client, created_at):
+        self.client = client
+        self.messages_sent = 0
+        self.last_used = created_at
+
+    @property
+    def is_connected(self):
+        return self.client.is_connected
+
+    def close(self):
+        if self.client.is_connected:
+            self.client.close()
+
+
+class SMTPPool:
+    """
+    Pool of long-lived, already authenticated asyncio SMTP connections.
+    * Connections are opened on demand (not more than pool size).
+    * Connection idle longer than health check interval is checked with NOOP before use.
+    * Idle connections are kept alive with NOOP in the background.
+    * Connection is closed after max messages and replaced with the new one.
+    * Send is retried once on the new connection if the old one was broken.
+    """
+
+    def __init__(self, hostname, port, username=None, password=None, starttls=True,
+                 size=4, max_messages=100, keepalive=30, health_check=10, timeout=30, loop=None):
+        """
+        :param hostname: SMTP server host
+        :param int port: SMTP server port
+        :param username: login username. If None - do not login
+        :param password: login password
+        :param starttls: True - upgrade connection with STARTTLS
+        :param int size: maximum number of connections
+        :param int max_messages: maximum messages sent by one connection
+        :param keepalive: interval in seconds to send NOOP on idle connections
+        :param health_check: idle time in seconds, after which connection is checked before use
+        :param timeout: SMTP commands timeout in seconds
+        :param loop: async main loop
+        """
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.size = size
+        self.max_messages = max_messages
+        self.keepalive = keepalive
+        self.health_check = health_check
+        self.timeout = timeout
+
+        self._loop = loop or asyncio.get_event_loop()
+        self._semaphore = asyncio.Semaphore(size, loop=self._loop)
+        self._idle = []
+        self._keepalive_task = None
+        self._closing = False
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def start(self):
+        _log.info('Start SMTP pool for %s:%s (size %d)', self.hostname, self.port, self.size)
+        self._keepalive_task = asyncio.ensure_future(self._keepalive_loop(), loop=self._loop)
+
+    async def close(self):
+        """ Stop keepalive loop and close idle connections. """
+        _log.info('Close SMTP pool')
+        self._closing = True
+
+        if self._keepalive_task:
+            self._keepalive_task.cancel()
+
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            await self._quit(connection)
+
+    async def _connect(self):
+        """
+        Open new SMTP connection: EHLO, STARTTLS and LOGIN.
+        :return: pooled connection
+        """
+        client = aiosmtplib.SMTP(hostname=self.hostname, port=self.port, timeout=self.timeout, loop=self._loop)
+        await client.connect()
+        await client.ehlo()
+
+        if self.starttls:
+            await client.starttls()
+            await client.ehlo()
+
+        if self.username:
+            await client.login(self.username, self.password)
+
+        _log.debug('New SMTP connection to %s:%s', self.hostname, self.port)
+        return _PooledConnection(client, created_at=self._loop.time())
+
+    async def _quit(self, connection):
+        try:
+            if connection.is_connected:
+                await connection.client.quit()
+        except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as err:
+            _log.debug('SMTP quit error: %r', err)
+        finally:
+            connection.close()
+
+    async def _is_healthy(self, connection):
+        """ Check connection with NOOP command. """
+        if not connection.is_connected:
+            return False
+        try:
+            await connection.client.noop()
+        except (aiosmtplib.SMTPException, OSError, asyncio.TimeoutError) as err:
+            _log.debug('SMTP connection health check failed: %r', err)
+            connection.close()
+            return False
+        return True
+
+    async def _acquire(self):
+        """
+        Get idle connection or open the new one.
+        Wait if all pool connections are in use.
+        """
+        if self._closing:
+            raise SMTPPoolError('SMTP pool is closed')
+
+        await self._semaphore.acquire()
+        try:
+            while self._idle:
+                connection = self._idle.pop()
+                idle_time = self._loop.time() - connection.last_used
+                if idle_time < self.health_check and connection.is_connected:
+                    return connection
+                if await self._is_healthy(connection):
+                    return connection
+
+            return await self._connect()
+
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def _release(self, connection, broken=False):
+        """
+        Return connection to the pool.
+        Broken and exhausted connections are closed.
+        """
+        connection.last_used = self._loop.time()
+
+        if broken or self._closing or not connection.is_connected:
+            connection.close()
+        elif connection.messages_sent >= self.max_messages or len(self._idle) >= self.size:
+            asyncio.ensure_future(self._quit(connection), loop=self._loop)
+        else:
+            self._idle.append(connection)
+
+        self._semaphore.release()
+
+    async def sendmail(self, sender, recipients, message):
+        """
+        Send message with pooled connection.
+        Retry once with the new connection if connection was lost.
+        :param sender: senders email address
+        :param list recipients: recipients email addresses
+        :param message: message content (str or bytes)
+        :return: dict with rejected recipients {recipient: server response}
+        :raise aiosmtplib.SMTPException, OSError, asyncio.TimeoutError: send error
+        """
+        for attempt in range(2):
+            connection = await self._acquire()
+            try:
+                errors, _ = await connection.client.sendmail(sender, recipients, message)
+            except (aiosmtplib.SMTPServerDisconnected, ConnectionError) as err:
+                self._release(connection, broken=True)
+                if attempt:
+                    raise
+                _log.warning('SMTP connection lost: %r. Reconnecting...', err)
+                continue
+            except aiosmtplib.SMTPRecipientsRefused:
+                self._release(connection)
+                raise
+            except BaseException:
+                self._release(connection, broken=True)
+                raise
+
+            connection.messages_sent += 1
+            self._release(connection)
+            return errors
+
+    async def _keepalive_loop(self):
+        """ Send NOOP on idle connections to keep them open. """
+        while not self._closing:
+            try:
+                await asyncio.sleep(self.keepalive, loop=self._loop)
+
+                now = self._loop.time()
+                stale = [conn for conn in self._idle if now - conn.last_used >= self.keepalive]
+                for connection in stale:
+                    if connection not in self._idle:
+                        continue
+                    self._idle.remove(connection)
+
+                    if not await self._is_healthy(connection):
+                        continue
+                    if self._closing or len(self._idle) >= self.size:
+                        await self._quit(connection)
+                        continue
+
+                    connection.last_used = self._loop.time()
+                    self._idle.append(connection)
+
+            except asyncio.CancelledError:
+                break
+            except Exception as err:
+                _log.exception('SMTP keepalive error: %r', err)
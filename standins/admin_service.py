@@ -0,0 +1,133 @@
+#!venv/bin/python
+"""
+Local stand-in for the XOPay Admin Service.
+Serve e-mail directory (single and bulk lookups) and currency update
+endpoints with generated data to run notify service offline.
+
+    ./standins/admin_service.py --port 7128 --emails 3 --latency-ms 20
+"""
+import re
+import json
+import asyncio
+import logging
+import argparse
+from aiohttp import web
+
+__author__ = 'Kostel Serhii'
+
+URL_PREFIX = '/api/admin/dev'
+
+directory_path_regex = re.compile(
+    r'^/emails/(?:groups/(?P<group>[\w-]+)|users/(?P<user>[\w-]+)|stores/(?P<store>[\w-]+)/(?P<role>merchants|managers))$'
+)
+
+
+def jsonify(*args, **kwargs):
+    return web.Response(text=json.dumps(dict(*args, **kwargs)), content_type='application/json')
+
+
+class AdminServiceStandIn:
+    """
+    Admin service endpoints with generated e-mails.
+    Count lookups and bulk requests to check caching and batching.
+    """
+
+    def __init__(self, emails_per_lookup=3, latency=0.0):
+        """
+        :param int emails_per_lookup: number of e-mails for every group, store role
+        :param latency: response delay in seconds
+        """
+        self.emails_per_lookup = emails_per_lookup
+        self.latency = latency
+
+        self.lookups = 0
+        self.bulk_requests = 0
+        self.currency_updates = 0
+
+    def directory_emails(self, path):
+        """
+        Generate e-mails for the directory path.
+        :param path: directory path (e.g. /emails/groups/admin)
+        :return: e-mails list or None if path is wrong
+        """
+        match = directory_path_regex.match(path)
+        if not match:
+            return None
+
+        self.lookups += 1
+
+        info = match.groupdict()
+        if info['user']:
+            return ['user-%s@example.com' % info['user']]
+
+        name = info['group'] or '%s-%s' % (info['store'], info['role'])
+        return ['%s-%d@example.com' % (name, i) for i in range(self.emails_per_lookup)]
+
+    async def emails_lookup(self, request):
+        await asyncio.sleep(self.latency)
+        path = request.path[len(URL_PREFIX):]
+        emails = self.directory_emails(path)
+        if emails is None:
+            return web.Response(status=404, text=json.dumps({'error': 'Not Found'}), content_type='application/json')
+        return jsonify(emails=emails)
+
+    async def emails_bulk(self, request):
+        await asyncio.sleep(self.latency)
+        self.bulk_requests += 1
+
+        body = await request.json()
+        emails, errors = {}, {}
+        for path in body.get('urls', []):
+            path_emails = self.directory_emails(path)
+            if path_emails is None:
+                errors[path] = 'Not Found'
+            else:
+                emails[path] = path_emails
+
+        return jsonify(emails=emails, errors=errors)
+
+    async def currency_update(self, request):
+        await asyncio.sleep(self.latency)
+        self.currency_updates += 1
+        await request.json()
+        return jsonify(status='ok')
+
+    async def stats(self, request):
+        return jsonify(lookups=self.lookups, bulk_requests=self.bulk_requests, currency_updates=self.currency_updates)
+
+
+def create_app(loop=None, emails_per_lookup=3, latency=0.0):
+    """
+    Create admin service stand-in application.
+    :param loop: async main loop
+    :param int emails_per_lookup: number of e-mails for every group, store role
+    :param latency: response delay in seconds
+    """
+    app = web.Application(loop=loop)
+    standin = AdminServiceStandIn(emails_per_lookup=emails_per_lookup, latency=latency)
+    app['standin'] = standin
+
+    app.router.add_route('GET', URL_PREFIX + '/emails/groups/{name}', standin.emails_lookup)
+    app.router.add_route('GET', URL_PREFIX + '/emails/users/{user_id}', standin.emails_lookup)
+    app.router.add_route('GET', URL_PREFIX + '/emails/stores/{store_id}/merchants', standin.emails_lookup)
+    app.router.add_route('GET', URL_PREFIX + '/emails/stores/{store_id}/managers', standin.emails_lookup)
+    app.router.add_route('POST', URL_PREFIX + '/emails/bulk', standin.emails_bulk)
+    app.router.add_route('POST', URL_PREFIX + '/currency/update', standin.currency_update)
+    app.router.add_route('GET', URL_PREFIX + '/standin/stats', standin.stats)
+
+    return app
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='XOPay Admin Service stand-in.', allow_abbrev=False)
+    parser.add_argument('--port', type=int, default=7128, help='server port (default 7128)')
+    parser.add_argument('--emails', type=int, default=3, help='e-mails for every directory lookup (default 3)')
+    parser.add_argument('--latency-ms', type=int, default=0, help='response delay in milliseconds (default 0)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(datefmt='%Y-%m-%d %H:%M:%S', level='INFO')
+
+    web.run_app(create_app(emails_per_lookup=args.emails, latency=args.latency_ms / 1000),
+                host='127.0.0.1', port=args.port)
@@ -0,0 +1,268 @@
+"""
+In-process stand-in for the RabbitMQ broker.
+Implement the part of aioamqp client API used by the service
+(channel, queue_declare, basic_qos, basic_consume, basic_client_ack, basic_client_nack, publish)
+on top of asyncio, so queue consumers run without the broker.
+
+    broker = InProcessBroker()
+    aioamqp.connect = broker.connect
+"""
+import asyncio
+import logging
+import itertools
+from collections import deque, OrderedDict
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.standin.amqp')
+
+
+class Envelope:
+
+    def __init__(self, consumer_tag, delivery_tag, exchange_name, routing_key, is_redeliver=False):
+        self.consumer_tag = consumer_tag
+        self.delivery_tag = delivery_tag
+        self.exchange_name = exchange_name
+        self.routing_key = routing_key
+        self.is_redeliver = is_redeliver
+
+
+class Properties:
+
+    def __init__(self, headers=None, delivery_mode=None, **kwargs):
+        self.headers = headers
+        self.delivery_mode = delivery_mode
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+
+class Message:
+    """ Published message with publish time to measure latency. """
+
+    def __init__(self, message_id, body, properties, published_at):
+        self.message_id = message_id
+        self.body = body
+        self.properties = properties
+        self.published_at = published_at
+        self.routing_key = None
+
+
+class _Consumer:
+
+    def __init__(self, channel, callback, consumer_tag):
+        self.channel = channel
+        self.callback = callback
+        self.consumer_tag = consumer_tag
+
+
+class _Queue:
+
+    def __init__(self, name, arguments=None):
+        self.name = name
+        self.arguments = arguments or {}
+        self.messages = deque()
+        self.consumers = []
+        self._next_consumer = 0
+
+    def next_consumer(self):
+        """ Next consumer with free prefetch window (round robin) or None. """
+        for _ in range(len(self.consumers)):
+            consumer = self.consumers[self._next_consumer % len(self.consumers)]
+            self._next_consumer += 1
+            if consumer.channel.has_capacity():
+                return consumer
+        return None
+
+
+class Channel:
+
+    def __init__(self, broker, channel_id):
+        self.broker = broker
+        self.channel_id = channel_id
+        self.prefetch_count = 0
+        self.is_open = True
+
+        self._unacked = OrderedDict()
+        self._delivery_tags = itertools.count(1)
+
+    def has_capacity(self):
+        return self.is_open and (not self.prefetch_count or len(self._unacked) < self.prefetch_count)
+
+    def deliver(self, consumer, queue, message):
+        delivery_tag = next(self._delivery_tags)
+        self._unacked[delivery_tag] = (queue, message)
+        envelope = Envelope(consumer.consumer_tag, delivery_tag, '', queue.name)
+        asyncio.ensure_future(consumer.callback(self, message.body, envelope, message.properties))
+
+    async def queue_declare(self, queue_name, durable=False, arguments=None, **kwargs):
+        self.broker.declare_queue(queue_name, arguments)
+        return {'queue': queue_name, 'message_count': 0, 'consumer_count': 0}
+
+    async def basic_qos(self, prefetch_size=0, prefetch_count=0, connection_global=False):
+        self.prefetch_count = prefetch_count
+
+    async def basic_consume(self, callback, queue_name='', consumer_tag='', **kwargs):
+        if not asyncio.iscoroutinefunction(callback):
+            callback = asyncio.coroutine(callback)
+        consumer_tag = consumer_tag or 'ctag%d.%d' % (self.channel_id, id(callback))
+        self.broker.add_consumer(queue_name, _Consumer(self, callback, consumer_tag))
+        return {'consumer_tag': consumer_tag}
+
+    async def basic_client_ack(self, delivery_tag, multiple=False):
+        if multiple:
+            tags = [tag for tag in self._unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self._unacked else []
+
+        for tag in tags:
+            queue, message = self._unacked.pop(tag)
+            self.broker.acked(queue, message)
+
+        self.broker.dispatch_all()
+
+    async def basic_client_nack(self, delivery_tag, multiple=False, requeue=True):
+        if multiple:
+            tags = [tag for tag in self._unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self._unacked else []
+
+        for tag in tags:
+            queue, message = self._unacked.pop(tag)
+            if requeue:
+                queue.messages.appendleft(message)
+
+        self.broker.dispatch_all()
+
+    async def publish(self, payload, exchange_name, routing_key, properties=None, **kwargs):
+        self.broker.publish(routing_key, payload, properties=properties)
+
+    async def close(self):
+        """ Close channel, requeue unacked messages. """
+        self.is_open = False
+        unacked, self._unacked = self._unacked, OrderedDict()
+        for queue, message in reversed(unacked.values()):
+            queue.messages.appendleft(message)
+        self.broker.remove_channel_consumers(self)
+        self.broker.dispatch_all()
+
+
+class Protocol:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+
+    async def channel(self):
+        channel = Channel(self.broker, len(self.channels) + 1)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+
+
+class Transport:
+
+    def close(self):
+        pass
+
+
+class InProcessBroker:
+    """
+    RabbitMQ stand-in with the default exchange only.
+    * Queues are created on declare or on the first publish.
+    * Messages are delivered round robin to consumers within channels prefetch count.
+    * Queues with x-message-ttl dead-letter expired messages to x-dead-letter-routing-key queue.
+    * on_ack callback gets every acked message to measure latency.
+    """
+
+    def __init__(self, on_ack=None):
+        """
+        :param on_ack: function (queue name, message), called on message ack
+        """
+        self.on_ack = on_ack
+        self.queues = dict()
+
+        self.published = 0
+        self.acked_count = 0
+        self._message_ids = itertools.count(1)
+
+    async def connect(self, **connect_params):
+        """ aioamqp.connect replacement. """
+        return Transport(), Protocol(self)
+
+    def declare_queue(self, queue_name, arguments=None):
+        queue = self.queues.get(queue_name)
+        if queue is None:
+            queue = _Queue(queue_name, arguments)
+            self.queues[queue_name] = queue
+        elif arguments:
+            queue.arguments = arguments
+        return queue
+
+    def add_consumer(self, queue_name, consumer):
+        queue = self.declare_queue(queue_name)
+        queue.consumers.append(consumer)
+        self.dispatch(queue)
+
+    def remove_channel_consumers(self, channel):
+        for queue in self.queues.values():
+            queue.consumers = [consumer for consumer in queue.consumers if consumer.channel is not channel]
+
+    def consumers_count(self, queue_name):
+        queue = self.queues.get(queue_name)
+        return len(queue.consumers) if queue else 0
+
+    def publish(self, routing_key, body, properties=None, headers=None):
+        """
+        Publish message to the queue through the default exchange.
+        :param routing_key: queue name
+        :param bytes body: message body
+        :param properties: dict with message properties
+        :param headers: dict with message headers
+        :return: published message
+        """
+        properties = dict(properties or {})
+        if headers:
+            properties['headers'] = dict(properties.get('headers') or {}, **headers)
+
+        loop = asyncio.get_event_loop()
+        message = Message(next(self._message_ids), body, Properties(**properties), loop.time())
+        self.published += 1
+        self._enqueue(routing_key, message)
+        return message
+
+    def _enqueue(self, queue_name, message):
+        queue = self.declare_queue(queue_name)
+        message.routing_key = queue_name
+
+        ttl = queue.arguments.get('x-message-ttl')
+        dead_letter_queue = queue.arguments.get('x-dead-letter-routing-key')
+        if ttl is not None and dead_letter_queue:
+            asyncio.get_event_loop().call_later(ttl / 1000, self._enqueue, dead_letter_queue, message)
+            return
+
+        queue.messages.append(message)
+        self.dispatch(queue)
+
+    def dispatch(self, queue):
+        while queue.messages:
+            consumer = queue.next_consumer()
+            if consumer is None:
+                return
+            consumer.channel.deliver(consumer, queue, queue.messages.popleft())
+
+    def dispatch_all(self):
+        for queue in self.queues.values():
+            self.dispatch(queue)
+
+    def acked(self, queue, message):
+        self.acked_count += 1
+        if self.on_ack is not None:
+            self.on_ack(queue.name, message)
+
+    def depth(self):
+        """ Ready messages by queue name. """
+        return {name: len(queue.messages) for name, queue in self.queues.items()}
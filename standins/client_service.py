@@ -0,0 +1,85 @@
+#!venv/bin/python
+"""
+Local stand-in for the XOPay Client Service.
+Accept payment status updates to run notify service offline.
+
+    ./standins/client_service.py --port 7254 --latency-ms 20 --error-rate 0.01
+"""
+import json
+import random
+import asyncio
+import logging
+import argparse
+from aiohttp import web
+
+__author__ = 'Kostel Serhii'
+
+URL_PREFIX = '/api/client/dev'
+
+
+def jsonify(*args, **kwargs):
+    return web.Response(text=json.dumps(dict(*args, **kwargs)), content_type='application/json')
+
+
+class ClientServiceStandIn:
+    """
+    Client service payment update endpoint.
+    Fail part of the updates with 503 to check retries.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        """
+        :param latency: response delay in seconds
+        :param error_rate: part of the updates to fail (0..1)
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+
+        self.updates = 0
+        self.errors = 0
+
+    async def payment_update(self, request):
+        await asyncio.sleep(self.latency)
+        await request.json()
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text='{"error": "Service Unavailable"}', content_type='application/json')
+
+        self.updates += 1
+        return jsonify(id=request.match_info['pay_id'], status='ok')
+
+    async def stats(self, request):
+        return jsonify(updates=self.updates, errors=self.errors)
+
+
+def create_app(loop=None, latency=0.0, error_rate=0.0):
+    """
+    Create client service stand-in application.
+    :param loop: async main loop
+    :param latency: response delay in seconds
+    :param error_rate: part of the updates to fail (0..1)
+    """
+    app = web.Application(loop=loop)
+    standin = ClientServiceStandIn(latency=latency, error_rate=error_rate)
+    app['standin'] = standin
+
+    app.router.add_route('PUT', URL_PREFIX + '/payment/{pay_id}', standin.payment_update)
+    app.router.add_route('GET', URL_PREFIX + '/standin/stats', standin.stats)
+
+    return app
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='XOPay Client Service stand-in.', allow_abbrev=False)
+    parser.add_argument('--port', type=int, default=7254, help='server port (default 7254)')
+    parser.add_argument('--latency-ms', type=int, default=0, help='response delay in milliseconds (default 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='part of the updates to fail (default 0)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(datefmt='%Y-%m-%d %H:%M:%S', level='INFO')
+
+    web.run_app(create_app(latency=args.latency_ms / 1000, error_rate=args.error_rate),
+                host='127.0.0.1', port=args.port)
@@ -0,0 +1,116 @@
+"""
+In-memory stand-in for the motor database.
+Async facade over mongomock with the motor 0.6 (pymongo 2.8) collection API
+used by the service: find, find_one, insert, update, remove, create_index.
+
+    db = create_database('xopay_notify_db')
+    app = create_app(db=db)
+"""
+import asyncio
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+__author__ = 'Kostel Serhii'
+
+
+class AsyncCursor:
+    """ Motor cursor over the mongomock cursor. """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._buffer = None
+
+    def sort(self, key_or_list, direction=None):
+        self._cursor = self._cursor.sort(key_or_list, direction)
+        return self
+
+    def limit(self, limit):
+        self._cursor = self._cursor.limit(limit)
+        return self
+
+    async def to_list(self, length):
+        documents = list(self._cursor)
+        return documents if length is None else documents[:length]
+
+    @property
+    def fetch_next(self):
+        return self._fetch_next()
+
+    async def _fetch_next(self):
+        if self._buffer is None:
+            self._buffer = list(self._cursor)
+            self._buffer.reverse()
+        await asyncio.sleep(0)
+        return bool(self._buffer)
+
+    def next_object(self):
+        return self._buffer.pop() if self._buffer else None
+
+
+class AsyncCollection:
+    """ Motor collection over the mongomock collection. """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, spec=None, projection=None):
+        return AsyncCursor(self._collection.find(spec or {}, projection))
+
+    async def find_one(self, spec=None, projection=None):
+        return self._collection.find_one(spec or {}, projection)
+
+    async def insert(self, doc_or_docs, **kwargs):
+        if isinstance(doc_or_docs, dict):
+            return self._collection.insert_one(doc_or_docs).inserted_id
+        return self._collection.insert_many(list(doc_or_docs)).inserted_ids
+
+    async def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        update = self._collection.update_many if multi else self._collection.update_one
+        result = update(spec, document, upsert=upsert)
+        return {'ok': 1, 'n': result.matched_count, 'updatedExisting': bool(result.matched_count)}
+
+    async def remove(self, spec_or_id=None, **kwargs):
+        if spec_or_id is None:
+            spec_or_id = {}
+        elif not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        return {'ok': 1, 'n': self._collection.delete_many(spec_or_id).deleted_count}
+
+    async def create_index(self, keys, **kwargs):
+        kwargs.pop('background', None)
+        return self._collection.create_index(keys, **kwargs)
+
+
+class AsyncDatabase:
+    """ Motor database over the mongomock database. """
+
+    def __init__(self, database):
+        self._database = database
+        self._collections = dict()
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = AsyncCollection(self._database[name])
+            self._collections[name] = collection
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+
+def create_database(name):
+    """
+    Create in-memory database.
+    :param name: database name
+    :return: async database
+    :raise RuntimeError: mongomock is not installed
+    """
+    if mongomock is None:
+        raise RuntimeError('mongomock is required for in-memory database: pip install -r requirements-dev.txt')
+    return AsyncDatabase(mongomock.MongoClient()[name])
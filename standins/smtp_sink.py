@@ -0,0 +1,149 @@
+#!venv/bin/python
+"""
+Local SMTP sink: accept and count messages, deliver nothing.
+Support EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP and QUIT without TLS and AUTH
+(run the service with MAIL_USE_STARTTLS = False and MAIL_USERNAME = None).
+
+    ./standins/smtp_sink.py --port 8025 --latency-ms 5
+"""
+import socket
+import asyncio
+import logging
+import argparse
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.standin.smtp')
+
+
+class SMTPSinkProtocol(asyncio.Protocol):
+    """ One SMTP client connection. """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.transport = None
+
+        self._buffer = b''
+        self._data_lines = None
+        self._recipients = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sink.connections += 1
+        self._reply('220 smtp-sink ESMTP ready')
+
+    def _reply(self, *lines):
+        if self.transport.is_closing():
+            return
+        text = ''.join('%s%s%s\r\n' % (line[:3], '-' if n < len(lines) - 1 else ' ', line[4:])
+                       for n, line in enumerate(lines))
+        self.transport.write(text.encode())
+
+    def data_received(self, data):
+        self._buffer += data
+        while b'\r\n' in self._buffer:
+            line, self._buffer = self._buffer.split(b'\r\n', 1)
+            if self._data_lines is not None:
+                self._data_line(line)
+            else:
+                self._command(line.decode('utf-8', 'replace'))
+
+    def _command(self, line):
+        verb, _, argument = line.partition(' ')
+        verb = verb.upper()
+
+        if verb == 'EHLO':
+            self._reply('250 smtp-sink', '250 8BITMIME', '250 PIPELINING', '250 SIZE 33554432')
+        elif verb == 'HELO':
+            self._reply('250 smtp-sink')
+        elif verb == 'MAIL':
+            self._recipients = []
+            self._reply('250 OK')
+        elif verb == 'RCPT':
+            self._recipients.append(argument)
+            self._reply('250 OK')
+        elif verb == 'DATA':
+            self._data_lines = []
+            self._reply('354 End data with <CR><LF>.<CR><LF>')
+        elif verb in ('RSET', 'NOOP'):
+            self._recipients = [] if verb == 'RSET' else self._recipients
+            self._reply('250 OK')
+        elif verb == 'QUIT':
+            self._reply('221 Bye')
+            self.transport.close()
+        else:
+            self._reply('502 Command not implemented')
+
+    def _data_line(self, line):
+        if line != b'.':
+            self._data_lines.append(line)
+            return
+
+        size = sum(len(data_line) + 2 for data_line in self._data_lines)
+        self._data_lines = None
+        asyncio.ensure_future(self._message_received(len(self._recipients), size))
+
+    async def _message_received(self, recipients_count, size):
+        if self.sink.latency:
+            await asyncio.sleep(self.sink.latency)
+
+        self.sink.messages += 1
+        self.sink.recipients += recipients_count
+        self.sink.bytes += size
+        self._reply('250 OK queued')
+
+    def connection_lost(self, exc):
+        self.sink.connections_closed += 1
+
+
+class SMTPSink:
+    """ SMTP server, that counts messages, recipients and connections. """
+
+    def __init__(self, latency=0.0):
+        """
+        :param latency: delay in seconds before message is accepted
+        """
+        self.latency = latency
+
+        self.connections = 0
+        self.connections_closed = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+
+    def stats(self):
+        return dict(connections=self.connections, connections_closed=self.connections_closed,
+                    messages=self.messages, recipients=self.recipients, bytes=self.bytes)
+
+    async def start(self, host='127.0.0.1', port=8025, loop=None):
+        """
+        Start SMTP server.
+        :return: asyncio server
+        """
+        loop = loop or asyncio.get_event_loop()
+        return await loop.create_server(lambda: SMTPSinkProtocol(self), host, port)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='SMTP sink stand-in.', allow_abbrev=False)
+    parser.add_argument('--port', type=int, default=8025, help='server port (default 8025)')
+    parser.add_argument('--latency-ms', type=int, default=0, help='message accept delay in milliseconds (default 0)')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(datefmt='%Y-%m-%d %H:%M:%S', level='INFO')
+
+    main_loop = asyncio.get_event_loop()
+    smtp_sink = SMTPSink(latency=args.latency_ms / 1000)
+    main_loop.run_until_complete(smtp_sink.start(port=args.port))
+    _log.info('SMTP sink on 127.0.0.1:%d', args.port)
+    try:
+        main_loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    _log.info('SMTP sink stats: %r', smtp_sink.stats())
@@ -0,0 +1,123 @@
+import os
+import time
+import signal
+import logging
+import multiprocessing
+from multiprocessing.connection import wait
+
+__author__ = 'Kostel Serhii'
+
+
+_log = logging.getLogger('xop.supervisor')
+
+
+class _Worker:
+    """ Supervised process specification and its current process. """
+
+    def __init__(self, name, target, args):
+        self.name = name
+        self.target = target
+        self.args = args
+
+        self.process = None
+        self.started_at = 0
+        self.restarts = 0
+        self.restart_at = 0
+
+
+class Supervisor:
+    """
+    Run worker processes and keep them running.
+    * Worker, that exited while supervisor is running, is restarted.
+      Worker, that crashed soon after start, is restarted with growing delay.
+    * SIGTERM and SIGINT stop supervisor: signal is forwarded to all workers,
+      workers, that did not exit during stop timeout, are killed.
+    """
+
+    MIN_RESTART_DELAY_SEC = 1
+    MAX_RESTART_DELAY_SEC = 60
+
+    def __init__(self, stop_timeout=30, min_uptime=10):
+        """
+        :param stop_timeout: time in seconds to wait for workers exit on stop
+        :param min_uptime: worker running less than min uptime is restarted with delay
+        """
+        self.stop_timeout = stop_timeout
+        self.min_uptime = min_uptime
+
+        self._workers = []
+        self._stopping = False
+
+    def add_worker(self, name, target, *args):
+        """
+        Add worker process specification.
+        :param name: worker process name
+        :param target: function to run in the worker process
+        :param args: function arguments
+        """
+        self._workers.append(_Worker(name, target, args))
+
+    def _start_worker(self, worker):
+        worker.process = multiprocessing.Process(name=worker.name, target=worker.target, args=worker.args)
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        _log.info('Worker %s started (pid %d)', worker.name, worker.process.pid)
+
+    def _on_worker_exit(self, worker):
+        """ Log worker exit and plan its restart. """
+        uptime = time.monotonic() - worker.started_at
+        _log.error('Worker %s (pid %d) exited with code %s after %.1f sec',
+                   worker.name, worker.process.pid, worker.process.exitcode, uptime)
+
+        worker.restarts = worker.restarts + 1 if uptime < self.min_uptime else 0
+        delay = 0
+        if worker.restarts:
+            delay = min(self.MIN_RESTART_DELAY_SEC * 2 ** (worker.restarts - 1), self.MAX_RESTART_DELAY_SEC)
+            _log.warning('Worker %s is crashing. Restart in %d sec', worker.name, delay)
+
+        worker.process = None
+        worker.restart_at = time.monotonic() + delay
+
+    def _handle_signal(self, signum, frame):
+        if not self._stopping:
+            _log.info('Supervisor got signal %d. Stopping workers...', signum)
+        self._stopping = True
+
+    def _stop_workers(self):
+        """ Forward SIGTERM to the workers, wait and kill the rest. """
+        running = [w.process for w in self._workers if w.process is not None and w.process.is_alive()]
+        for process in running:
+            os.kill(process.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.stop_timeout
+        for process in running:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                _log.error('Worker %s (pid %d) did not stop. Kill it', process.name, process.pid)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+    def run(self):
+        """ Start all workers and supervise them until SIGTERM or SIGINT. """
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+        _log.info('Supervisor started (pid %d) with %d workers', os.getpid(), len(self._workers))
+        for worker in self._workers:
+            self._start_worker(worker)
+
+        while not self._stopping:
+            now = time.monotonic()
+            for worker in self._workers:
+                if worker.process is None and now >= worker.restart_at:
+                    self._start_worker(worker)
+
+            sentinels = {w.process.sentinel: w for w in self._workers if w.process is not None}
+            for sentinel in wait(list(sentinels), timeout=self.MIN_RESTART_DELAY_SEC):
+                worker = sentinels[sentinel]
+                worker.process.join()
+                if not self._stopping:
+                    self._on_worker_exit(worker)
+
+        self._stop_workers()
+        _log.info('Supervisor stopped')
@@ -1,58 +1,161 @@
 import logging
-import json
-import smtplib
 import asyncio
+import aiosmtplib
 import aiohttp
 import concurrent.futures
 
 from asyncio import TimeoutError
+from email.mime.text import MIMEText
 from aiohttp.errors import ClientError
-from json.decoder import JSONDecodeError
 
 import auth
+import cache
+import codec
+import batching
+import smtp_pool
+import circuit_breaker
+import report
+import metrics
 from config import config
 
 __author__ = 'Kostel Serhii'
 
 
 _log = logging.getLogger('xop.utils')
-_email_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 _sms_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+_directory_cache = None
+_directory_batcher = None
+_smtp_pool = None
+_http_session = None
+_circuit_breakers = None
+_admin_reports = None
 
+_smtp_seconds = metrics.histogram('notify_smtp_send_seconds', 'SMTP transaction latency', ('server',))
+_smtp_errors = metrics.counter('notify_smtp_errors_total', 'SMTP transactions failed', ('server',))
+_http_seconds = metrics.histogram('notify_http_request_seconds', 'HTTP request latency', ('upstream',))
+_http_requests = metrics.counter('notify_http_requests_total', 'HTTP requests by result', ('upstream', 'result'))
+metrics.gauge('notify_sms_executor_queue_depth', 'SMS sends waiting for executor thread').set_function(
+    lambda: _sms_executor._work_queue.qsize())
 
-def _send_email_sync(email_to, subject, text, email_from=None):
+
+def setup_smtp_pool(loop=None):
     """
-    Send an email from "email_from" to "email_to" address with subject and content text
-    :param email_from: senders email address. If None - use default
-    :param email_to: recipients email address
-    :param subject: mail subject
-    :param text: mail content
+    Create and start SMTP connection pool from config.
+    :param loop: async main loop
+    :return: SMTP pool
     """
-    email_from = email_from or config['MAIL_DEFAULT_SENDER']
+    global _smtp_pool
+
+    hostname, _, port = config['MAIL_SERVER'].partition(':')
+    _smtp_pool = smtp_pool.SMTPPool(
+        hostname=hostname,
+        port=int(port or 25),
+        username=config['MAIL_USERNAME'],
+        password=config['MAIL_PASSWORD'],
+        starttls=config.get('MAIL_USE_STARTTLS', True),
+        size=config.get('MAIL_POOL_SIZE', 4),
+        max_messages=config.get('MAIL_CONNECTION_MAX_MESSAGES', 100),
+        keepalive=config.get('MAIL_KEEPALIVE_SEC', 30),
+        health_check=config.get('MAIL_HEALTH_CHECK_SEC', 10),
+        timeout=config.get('MAIL_TIMEOUT_SEC', 30),
+        loop=loop
+    )
+    _smtp_pool.start()
+    return _smtp_pool
+
+
+async def close_smtp_pool():
+    """ Close SMTP connection pool. """
+    global _smtp_pool
+    if _smtp_pool is not None:
+        await _smtp_pool.close()
+        _smtp_pool = None
+
+
+def _get_smtp_pool():
+    return _smtp_pool or setup_smtp_pool()
+
+
+def _build_email_message(email_from, subject, text, email_to=None):
+    """
+    Build MIME message bytes once for all recipients.
+    Recipients list is sent in the SMTP envelope only.
+    :param str email_from: senders email address
+    :param str subject: mail subject
+    :param str text: mail content
+    :param str email_to: recipients email address for "To" header. If None - undisclosed recipients
+    :return: message bytes
+    """
+    message = MIMEText(text, 'plain', 'utf-8')
+    message['From'] = email_from
+    message['To'] = email_to or 'undisclosed-recipients:;'
+    message['Subject'] = subject
+    return message.as_bytes()
+
 
+async def _send_email_transaction(email_from, recipients, content):
+    """
+    Send message to the recipients chunk in one SMTP transaction.
+    :return: dict with rejected recipients {recipient: reason}
+    """
+    server = config['MAIL_SERVER']
     try:
-        with smtplib.SMTP(config['MAIL_SERVER']) as server:
-            server.ehlo()
-            server.starttls()
-            server.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        with _smtp_seconds.labels(server).time():
+            errors = await _get_smtp_pool().sendmail(email_from, recipients, content)
+        return {recipient: str(response) for recipient, response in errors.items()}
 
-            content = "From:{}\nSubject:{}\n\n{}".format(email_from, subject, text)
-            server.sendmail(email_from, email_to, content)
+    except aiosmtplib.SMTPRecipientsRefused as err:
+        return {refused.recipient: str(refused) for refused in err.recipients}
 
-    except (smtplib.SMTPException, OSError) as err:
+    except (aiosmtplib.SMTPException, smtp_pool.SMTPPoolError, OSError, TimeoutError) as err:
+        _smtp_errors.labels(server).inc()
         _log.critical('Send Email Error: %r', err)
+        return {recipient: repr(err) for recipient in recipients}
+
+
+async def send_bulk_email(emails_to, subject, text, email_from=None):
+    """
+    Send the same email to many recipients.
+    Message is built once and sent in SMTP transactions
+    with up to MAIL_RECIPIENTS_PER_TRANSACTION recipients (RCPT TO) each.
+    :param emails_to: recipients email addresses
+    :param str subject: mail subject
+    :param str text: mail content
+    :param str email_from: senders email address. If None - use default
+    :return: dict with rejected recipients {recipient: reason}
+    """
+    email_from = email_from or config['MAIL_DEFAULT_SENDER']
+    emails_to = sorted(set(emails_to))
+    if not emails_to:
+        return {}
+
+    content = _build_email_message(email_from, subject, text, email_to=emails_to[0] if len(emails_to) == 1 else None)
+
+    chunk_size = config.get('MAIL_RECIPIENTS_PER_TRANSACTION', 50)
+    chunks = [emails_to[i:i + chunk_size] for i in range(0, len(emails_to), chunk_size)]
+    chunk_rejects = await asyncio.gather(*[_send_email_transaction(email_from, chunk, content) for chunk in chunks])
+
+    rejected = dict()
+    for rejects in chunk_rejects:
+        rejected.update(rejects)
+
+    if rejected:
+        _log.error('Email "%s" rejected for %d/%d recipients: %r', subject, len(rejected), len(emails_to), rejected)
+
+    return rejected
 
 
 async def send_email(email_to, subject, text, email_from=None):
     """
-    Send email asyncronously with thread executor
+    Send an email from "email_from" to "email_to" address with subject and content text
+    using pooled SMTP connection.
     :param str email_to: recipients email address
     :param str subject: mail subject
     :param str text: mail content
     :param str email_from: senders email address. If None - use default
+    :return: dict with rejected recipients {recipient: reason}
     """
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(_email_executor, _send_email_sync, email_to, subject, text, email_from)
+    return await send_bulk_email([email_to], subject, text, email_from=email_from)
 
 
 def _send_sms_sync(phone, text):
@@ -82,6 +185,61 @@ async def send_sms(phone, text):
     await loop.run_in_executor(_sms_executor, _send_sms_sync, phone, text)
 
 
+def setup_http_session(loop=None):
+    """
+    Create application-scoped http client session
+    with keep-alive connection pool and DNS cache.
+    :param loop: async main loop
+    :return: http client session
+    """
+    global _http_session
+
+    connector = aiohttp.TCPConnector(
+        limit=config.get('HTTP_CONNECTIONS_PER_HOST', 20),
+        use_dns_cache=True,
+        keepalive_timeout=config.get('HTTP_KEEPALIVE_SEC', 30),
+        conn_timeout=config.get('HTTP_CONNECT_TIMEOUT_SEC', 5),
+        loop=loop
+    )
+    _http_session = aiohttp.ClientSession(connector=connector, loop=loop)
+    return _http_session
+
+
+def close_http_session():
+    """ Close http client session and all its connections. """
+    global _http_session
+    if _http_session is not None:
+        _http_session.close()
+        _http_session = None
+
+
+def get_http_session():
+    """ Shared http client session for all outbound requests. """
+    return _http_session or setup_http_session()
+
+
+def _get_circuit_breakers():
+    global _circuit_breakers
+    if _circuit_breakers is None:
+        _circuit_breakers = circuit_breaker.CircuitBreakerRegistry(
+            upstreams=dict(client=config.get('CLIENT_BASE_URL', ''), admin=config.get('ADMIN_BASE_URL', '')),
+            failure_rate=config.get('CIRCUIT_FAILURE_RATE', 0.5),
+            window_size=config.get('CIRCUIT_WINDOW_SIZE', 20),
+            min_calls=config.get('CIRCUIT_MIN_CALLS', 5),
+            open_timeout=config.get('CIRCUIT_OPEN_SEC', 30),
+            half_open_probes=config.get('CIRCUIT_HALF_OPEN_PROBES', 1)
+        )
+    return _circuit_breakers
+
+
+def _record_response(breaker, rest_status):
+    """ Server errors and missing responses are upstream failures. """
+    if rest_status is None or rest_status >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
 async def http_request(url, method='GET', body=None, params=None):
     """
     Create async http request to the REST API.
@@ -92,27 +250,50 @@ async def http_request(url, method='GET', body=None, params=None):
     :param params: dict with request url arguments
     :return: tuple (response body dict, error message)
     """
-    data = json.dumps(body)
+    data = codec.dumps_bytes(body)
     headers = {
         'Content-Type': 'application/json',
         'Authorization': 'Bearer %s' % auth.get_system_token()
     }
 
+    # every allowed request must record its result or release half-open probe
+    breaker = _get_circuit_breakers().for_url(url)
+    if not breaker.allow_request():
+        _http_requests.labels(breaker.name, 'circuit_open').inc()
+        err_msg = 'HTTP request error: circuit %s is open' % breaker.name
+        _log.warning(err_msg)
+        return None, err_msg
+
+    rest_status = None
     try:
-        with aiohttp.ClientSession() as session:
-            with aiohttp.Timeout(10):
-                async with session.request(method, url, data=data, params=params, headers=headers) as response:
-                    rest_status = response.status
-                    resp_body = await response.json()
+        with _http_seconds.labels(breaker.name).time(), aiohttp.Timeout(config.get('HTTP_REQUEST_TIMEOUT_SEC', 10)):
+            async with get_http_session().request(method, url, data=data, params=params, headers=headers) as response:
+                rest_status = response.status
+                raw_body = await response.read()
+                resp_body = codec.loads(raw_body) if raw_body.strip() else None
 
-    except (JSONDecodeError, TypeError) as err:
+    except (codec.DecodeError, TypeError) as err:
+        _record_response(breaker, rest_status)
+        _http_requests.labels(breaker.name, 'bad_response').inc()
         err_msg = 'HTTP bad response error: %r' % err
         _log.error(err_msg)
         return None, err_msg
     except (TimeoutError, ClientError) as err:
+        breaker.record_failure()
+        _http_requests.labels(breaker.name, 'error').inc()
         err_msg = 'HTTP request error: %r' % err
         _log.critical(err_msg)
         return None, err_msg
+    except asyncio.CancelledError:
+        # cancellation says nothing about the upstream
+        breaker.release_probe()
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+
+    _record_response(breaker, rest_status)
+    _http_requests.labels(breaker.name, rest_status).inc()
 
     if rest_status != 200:
         err_msg = 'HTTP wrong status %d. Error detail: %r' % (rest_status, resp_body)
@@ -122,8 +303,86 @@ async def http_request(url, method='GET', body=None, params=None):
     return resp_body, None
 
 
+def _get_directory_cache():
+    global _directory_cache
+    if _directory_cache is None:
+        _directory_cache = cache.TTLCache(
+            max_size=config.get('DIRECTORY_CACHE_SIZE', 1024),
+            ttl=config.get('DIRECTORY_CACHE_TTL_SEC', 60)
+        )
+    return _directory_cache
+
+
+async def _bulk_emails_request(urls):
+    """
+    Request emails for many admin service directory urls with one bulk request.
+    Bulk request body: {"urls": [path, ...]}, where path is url without admin base url.
+    Bulk response body: {"emails": {path: [email, ...]}, "errors": {path: error message}}.
+    If bulk request failed or response body is not an object - request every url separately.
+    :param list urls: admin service emails urls
+    :return: dict with tuples (response body dict, error message) by urls
+    """
+    admin_base_url = config.get('ADMIN_BASE_URL')
+    paths = {url[len(admin_base_url):]: url for url in urls}
+
+    result, error = await http_request(admin_base_url + config['DIRECTORY_BULK_URL'],
+                                       method='POST', body={'urls': list(paths)})
+    if error or not isinstance(result, dict):
+        _log.warning('Bulk emails request error: %s. Request %d urls separately',
+                     error or 'wrong response body %r' % (result,), len(urls))
+        results = await asyncio.gather(*map(http_request, urls))
+        return dict(zip(urls, results))
+
+    emails, errors = result.get('emails', {}), result.get('errors', {})
+    missing_error = 'HTTP bulk response error: url missing in response'
+
+    return {
+        url: ({'emails': emails[path]}, None) if path in emails else (None, errors.get(path, missing_error))
+        for path, url in paths.items()
+    }
+
+
+def _get_directory_batcher():
+    global _directory_batcher
+    if _directory_batcher is None:
+        _directory_batcher = batching.MicroBatcher(
+            _bulk_emails_request,
+            max_delay=config.get('DIRECTORY_BATCH_DELAY_MS', 5) / 1000,
+            max_size=config.get('DIRECTORY_BATCH_SIZE', 50)
+        )
+    return _directory_batcher
+
+
+async def _request_emails(url):
+    """
+    Request emails from the admin service directory url.
+    Use micro-batched bulk request if it is enabled.
+    """
+    if config.get('DIRECTORY_BULK_URL') and url.startswith(config.get('ADMIN_BASE_URL')):
+        return await _get_directory_batcher().resolve(url)
+    return await http_request(url)
+
+
+async def get_emails(url):
+    """
+    Request emails list from the admin service directory url.
+    Responses are cached, errors are cached for a shorter time.
+    Concurrent requests for the same url make one http request,
+    concurrent requests for different urls are joined into bulk requests.
+    :param url: admin service emails url
+    :return: tuple (response body dict, error message)
+    """
+    directory_cache = _get_directory_cache()
+    error_ttl = config.get('DIRECTORY_CACHE_ERROR_TTL_SEC', 5)
+
+    def response_ttl(response):
+        return error_ttl if response[1] else None
+
+    return await directory_cache.get_or_load(url, lambda: _request_emails(url), ttl_func=response_ttl)
+
+
 async def get_admins_emails():
-    result, error = await http_request(config.get('ADMIN_BASE_URL') + '/emails/groups/admin')
+    result, error = await get_emails(config.get('ADMIN_BASE_URL') + '/emails/groups/admin')
     if error:
         _log.critical('Error get admins emails.\nWrong response from Admin Service.\n%s' % error)
         return
@@ -131,10 +390,38 @@ async def get_admins_emails():
     return result.get('emails')
 
 
+async def _send_admin_report(subject, text):
+    admin_email_list = await get_admins_emails()
+    if not admin_email_list:
+        _log.warning('Report not send. Admin email address is missing!')
+        return
+
+    await send_bulk_email(admin_email_list, subject=subject, text=text)
+
+
+def _get_admin_reports():
+    global _admin_reports
+    if _admin_reports is None:
+        _admin_reports = report.ReportAggregator(
+            _send_admin_report,
+            window=config.get('REPORT_DIGEST_WINDOW_SEC', 60),
+            max_entries=config.get('REPORT_DIGEST_MAX_ENTRIES', 1000),
+            max_samples=config.get('REPORT_DIGEST_MAX_SAMPLES', 10)
+        )
+    return _admin_reports
+
+
 async def report_to_admin(subject, text):
-        admin_email_list = await get_admins_emails()
-        if not admin_email_list:
-            _log.warning('Report not send. Admin email address is missing!')
-            return
+    """
+    Queue report to the admins.
+    Reports are collected by subject and sent as one digest per time window.
+    :param str subject: report subject
+    :param str text: report text
+    """
+    _get_admin_reports().add(subject, text)
+
 
-        await asyncio.gather(*[send_email(email, subject=subject, text=text) for email in admin_email_list])
+async def flush_admin_reports():
+    """ Send all queued admin reports now. """
+    if _admin_reports is not None:
+        await _admin_reports.flush()